@@ -0,0 +1,115 @@
+"""Compare peak memory of the ImageMagick and tiled visual comparisons.
+
+Generates pairs of test images at increasing viewport sizes and runs each
+comparison mode in a fresh child process, reporting the peak resident set size
+of the comparison and the subprocesses it started. The tiled mode holds a band
+of rows and the changed regions open at its edge, so it should stay flat as the
+viewport grows taller and grow only with its width.
+
+    python bench/compare_memory.py 800x600 2000x4000 4000x16000
+"""
+import argparse
+import asyncio
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src" / "same_story_api"
+
+
+def make_images(directory, width, height):
+    """A screenshot and a slightly different check frame"""
+    screenshot = directory / "screenshot.png"
+    frame = directory / "frame.png"
+    subprocess.run(
+        ["convert", "-size", f"{width}x{height}", "gradient:white-navy", screenshot],
+        check=True,
+    )
+    subprocess.run(
+        [
+            "convert",
+            screenshot,
+            "-fill",
+            "red",
+            "-draw",
+            f"rectangle {width // 4},{height // 4} {width // 2},{height // 2}",
+            frame,
+        ],
+        check=True,
+    )
+    return screenshot, frame
+
+
+def run_imagemagick(screenshot, frame, directory):
+    subprocess.run(
+        f"convert '{screenshot}' -flatten -grayscale Rec709Luminance "
+        f"'{frame}' -flatten -grayscale Rec709Luminance "
+        "-clone 0-1 -compose darken -composite "
+        f"-channel RGB -combine {directory}/gray_difference.png",
+        shell=True,
+        check=True,
+    )
+    subprocess.run(
+        f"compare '{screenshot}' '{frame}' -highlight-color blue "
+        f"{directory}/blue_difference.png",
+        shell=True,
+    )
+    subprocess.run(f"compare -metric MAE '{screenshot}' '{frame}' null", shell=True)
+
+
+def run_tiled(screenshot, frame, directory):
+    sys.path.insert(0, str(SRC))
+    from compare import compare_images
+
+    asyncio.run(
+        compare_images(
+            screenshot,
+            frame,
+            directory / "gray_difference.png",
+            directory / "blue_difference.png",
+        )
+    )
+
+
+def child(mode, screenshot, frame, directory):
+    """Run one comparison and print the peak RSS in MiB of this process and of
+    the largest subprocess it waited for"""
+    start = time.time()
+    {"imagemagick": run_imagemagick, "tiled": run_tiled}[mode](screenshot, frame, directory)
+    duration = time.time() - start
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"{self_rss:.0f} {children_rss:.0f} {duration:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("sizes", nargs="*", default=["800x600", "2000x4000", "4000x16000"])
+    parser.add_argument("--child", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        mode, screenshot, frame, directory = args.child
+        return child(mode, Path(screenshot), Path(frame), Path(directory))
+
+    print(f"{'viewport':>12} {'mode':>12} {'python MiB':>11} {'subproc MiB':>12} {'secs':>6}")
+    for size in args.sizes:
+        width, height = map(int, size.split("x"))
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            screenshot, frame = make_images(directory, width, height)
+            for mode in "imagemagick", "tiled":
+                r = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, screenshot, frame, directory],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+                self_rss, children_rss, duration = r.stdout.split()[-3:]
+                print(f"{size:>12} {mode:>12} {self_rss:>11} {children_rss:>12} {duration:>6}")
+
+
+if __name__ == "__main__":
+    main()
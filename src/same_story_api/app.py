@@ -1,27 +1,45 @@
 import asyncio
 import json
 import os
+import shutil
 import signal
+import socket
+from functools import partial
+from time import time
+
+# when the worker started, for STARTUP_PROFILE
+STARTED_AT = time()
 
 from aiobotocore.session import get_session
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from engi_message_queue import SNSFanoutSQS, get_name
-from helpful_scripts import log, setup_env
-
-setup_env()
-
-from check import CheckRequest
+from check import NPM_REGISTRY, CheckRequest
+from helpful_scripts import (
+    ResultsIndex,
+    get_abs_path,
+    get_cancel_key,
+    get_free_memory,
+    get_latest,
+    get_latest_key,
+    get_storage,
+    get_story_key,
+    gettempdir,
+    log,
+)
+from metrics import Load
+from procs import Processes
+from publisher import StatusPublisher
+from queues import FairScheduler, Job, JobQueue, get_queue_configs
+from tracing import flush
 
-QUEUE_URL = os.environ["QUEUE_URL"]
-# if storycap wouldn't mind us running multiple jobs concurrently, we could up this
+# if storycap wouldn't mind us running multiple jobs concurrently, we could up this,
+# the most messages to receive at a time when ADAPTIVE_POLLING (see metrics.py)
 MAX_QUEUE_MESSAGES = int(os.environ.get("MAX_QUEUE_MESSAGES", 1))
-# how long in seconds to wait when receiving messages from the main SQS job queue
+# how long in seconds to wait when receiving messages from the main SQS job
+# queue, until there are check durations to go by when ADAPTIVE_POLLING
 WAIT_TIME = int(os.environ.get("WAIT_TIME", 5))
-# visibility timeout for status messages
-STATUS_VISIBILITY_TIMEOUT = int(os.environ.get("STATUS_VISIBILITY_TIMEOUT", 5))
 
 # Signal sent by AWS during ECS task shutdown before SIGKILL / forceful task termination
 ECS_SIG_CANCEL = signal.SIGTERM
@@ -29,105 +47,372 @@ ECS_SIG_CANCEL = signal.SIGTERM
 # longer than it takes to complete the task
 TASK_SHUTDOWN_SECS = int(os.environ.get("TASK_SHUTDOWN_SECS", 120))
 
+# how many checks may be prepared (downloaded, checked out and installed) ahead
+# of the one being captured, 0 to run checks strictly one after the other
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", 1))
+# how far ADAPTIVE_POLLING may prefetch when preparing is slower than capturing
+PREFETCH_MAX_DEPTH = int(os.environ.get("PREFETCH_MAX_DEPTH", max(PREFETCH_DEPTH, 2)))
+# only prepare a check ahead while this much disk and memory (bytes) are free
+PREFETCH_MIN_FREE_DISK = int(os.environ.get("PREFETCH_MIN_FREE_DISK", 5 * 2**30))
+PREFETCH_MIN_FREE_MEMORY = int(os.environ.get("PREFETCH_MIN_FREE_MEMORY", 2**30))
+# how often in seconds to check whether prefetching may go ahead
+PREFETCH_POLL_SECS = int(os.environ.get("PREFETCH_POLL_SECS", 2))
+
+# how many checks from one job queue may be waiting or running at once, unless
+# set per queue in QUEUES (see queues.py), by default what fits the pipeline:
+# one capturing, PREFETCH_MAX_DEPTH prepared and MAX_QUEUE_MESSAGES waiting
+QUEUE_MAX_IN_FLIGHT = int(
+    os.environ.get("QUEUE_MAX_IN_FLIGHT", 1 + PREFETCH_MAX_DEPTH + MAX_QUEUE_MESSAGES)
+)
+# how often in seconds to log the wait times of each job queue
+QUEUE_STATS_SECS = int(os.environ.get("QUEUE_STATS_SECS", 60))
+
+# where this worker indexes the results of its checks, synced to
+# index/INDEX_SHARD.sqlite in storage every INDEX_SYNC_SECS if it has changed
+INDEX_PATH = str(
+    get_abs_path(os.environ.get("INDEX_PATH", gettempdir() / "same-story-index.sqlite"))
+)
+INDEX_SHARD = os.environ.get("INDEX_SHARD", socket.gethostname())
+INDEX_SYNC_SECS = int(os.environ.get("INDEX_SYNC_SECS", 60))
+
+# log how long each phase of starting up took, up to the first receive_message
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE")
+# what to get ready in the background while waiting for the first check, any of
+# npm (the npm cache) and browser (chromium and its libraries), "" for nothing
+PREWARM = os.environ.get("PREWARM", "npm,browser")
+PREWARM_BROWSER_CMD = os.environ.get(
+    "PREWARM_BROWSER_CMD", "chromium --headless --no-sandbox --disable-gpu --dump-dom about:blank"
+)
+
+
+class CheckRegistry(object):
+    """The queued and running jobs, by check_id and by story, so that a check
+    can be cancelled explicitly or superseded by a newer check of the same
+    story. Both are also marked in storage, where every worker checks before
+    the expensive stages of its checks."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.jobs = {}
+        self.stories = {}
+
+    def redelivered(self, check_id, receipt_handle):
+        """Whether the check is already queued or running here. Its job takes
+        the receipt handle of the latest delivery, the one SQS is sure to
+        delete the message with."""
+        job = self.jobs.get(check_id)
+        if job is None:
+            return False
+        log.info(f"ignoring redelivered {check_id=}")
+        job.receipt_handle = receipt_handle
+        return True
+
+    async def add(self, job):
+        check = job.check
+        check_id = check.spec_d["check_id"]
+        key = get_story_key(check.spec_d)
+        self.jobs[check_id] = job
+        older = self.stories.get(key)
+        if older is not None and older.sent_at > job.sent_at:
+            check.cancel("superseded", superseded_by=older.check.spec_d["check_id"])
+            return
+        if older is not None:
+            older.check.cancel("superseded", superseded_by=check_id)
+        self.stories[key] = job
+        await self.mark_latest(job)
+
+    async def mark_latest(self, job):
+        """Make job the newest check of its story in storage, unless another
+        worker has a newer one. Checks only give way to a marker with a later
+        sent_at, so if this fails, or races with another worker, older checks
+        elsewhere may run to the end but the newest is never cancelled."""
+        check = job.check
+        check_id = check.spec_d["check_id"]
+        try:
+            latest = await asyncio.to_thread(get_latest, self.storage, check.spec_d)
+            if latest is not None and latest["sent_at"] > job.sent_at:
+                check.cancel("superseded", superseded_by=latest["check_id"])
+                return
+            body = json.dumps({"check_id": check_id, "sent_at": job.sent_at})
+            await asyncio.to_thread(self.storage.put, get_latest_key(check.spec_d), body)
+        except Exception as e:
+            log.warning(f"couldn't mark {check_id=} as the latest of its story: {e!r}")
+
+    def remove(self, job):
+        self.jobs.pop(job.check.spec_d["check_id"], None)
+        key = get_story_key(job.check.spec_d)
+        if self.stories.get(key) is job:
+            del self.stories[key]
+
+    async def cancel(self, check_id):
+        """Mark the check as cancelled in storage, for whichever worker has it
+        or receives it later, and cancel it if it's here"""
+        body = json.dumps({"cancelled_at": time()})
+        await asyncio.to_thread(self.storage.put, get_cancel_key(check_id), body)
+        job = self.jobs.get(check_id)
+        if job is None:
+            log.info(f"marked {check_id=} as cancelled for other workers")
+            return
+        job.check.cancel("cancelled")
+
+    async def drained(self):
+        """Wait until every queued and running check has completed"""
+        while self.jobs:
+            await asyncio.sleep(1)
+
+
+class Prefetch(object):
+    """Bounds how far ahead of the check being captured the next checks are
+    prepared: by count, and by the disk and memory left for their code and
+    node_modules. The count follows load.prefetch_depth()."""
+
+    def __init__(self, load):
+        self.load = load
+        self.in_flight = 0
+
+    def has_room(self):
+        free_disk = shutil.disk_usage(gettempdir()).free
+        free_memory = get_free_memory()
+        if free_disk < PREFETCH_MIN_FREE_DISK or free_memory < PREFETCH_MIN_FREE_MEMORY:
+            log.info(f"not prefetching {free_disk=} {free_memory=}")
+            return False
+        return True
+
+    async def acquire(self):
+        # with nothing else in flight a check always goes ahead
+        while self.in_flight > self.load.prefetch_depth() or (
+            self.in_flight and not self.has_room()
+        ):
+            await asyncio.sleep(PREFETCH_POLL_SECS)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class IndexSync(object):
+    """Uploads this worker's results index whenever it has changed"""
+
+    def __init__(self, index, storage):
+        self.index = index
+        self.storage = storage
+        self.synced_changes = 0
+
+    async def sync(self):
+        changes = self.index.db.total_changes
+        if changes == self.synced_changes:
+            return
+        snapshot = self.index.snapshot(f"{INDEX_PATH}.snapshot")
+        try:
+            await asyncio.to_thread(
+                self.storage.upload_file, snapshot, f"index/{INDEX_SHARD}.sqlite"
+            )
+        except Exception as e:
+            log.exception(e)
+            return
+        self.synced_changes = changes
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(INDEX_SYNC_SECS)
+            await self.sync()
+
 
-def get_sns_topic(spec_d):
-    """Get the SNS topic for status updates. If an ARN is given in spec_d then
-    use it. Otherwise, create a temporary SQS -> SNS fanout. It will get cleaned
-    up by a separate process."""
-    topic_arn = spec_d.get("sns_topic_arn")
-    if topic_arn is not None:
-        return topic_arn
-    check_id = spec_d["check_id"]
-    name = f"{get_name()}-{check_id}-status"
-    fanout = SNSFanoutSQS(
-        name, persist=True, visibility_timeout=STATUS_VISIBILITY_TIMEOUT
-    ).create()
-    return fanout.topic_arn
-
-
-async def status_callback(sns, spec_d, msg):
-    topic_arn = get_sns_topic(spec_d)
-    if topic_arn is None:
-        return
-    log.info(f"sending status update to {topic_arn=} {msg=}")
-    kwargs = {
-        "TopicArn": topic_arn,
-        "Message": json.dumps(msg),
-    }
-    if topic_arn.endswith("fifo"):
-        # FIFO (first-in-first-out) topics require additional params for deduplication
-        kwargs.update(
-            {"MessageGroupId": msg["check_id"], "MessageDeduplicationId": str(msg["step"])}
-        )
-    await sns.publish(**kwargs)
-
-
-async def worker(n, queue):
+async def prefetcher(scheduler, prepared, prefetch, load):
+    """Runs the I/O bound stages of the next checks while the worker captures"""
     while True:
-        # dequeue a "work item"
-        sqs, sns, spec_d, receipt_handle = await queue.get()
-        log.info(f"worker {n} got {spec_d=}")
+        await prefetch.acquire()
+        job = await scheduler.get()
+        check = job.check
+        log.info(f"prefetcher got {check.spec_d=} from {job.job_queue.name}")
+        started_at = time()
+        queue = job.job_queue.name
+        check.trace.record("queue.sqs", job.sent_at, job.received_at, queue=queue)
+        check.trace.record("queue.worker", job.received_at, started_at, queue=queue)
         try:
-            await CheckRequest(spec_d, lambda msg: status_callback(sns, spec_d, msg)).run()
+            # a cancelled check stops straight away with a terminal status
+            with check.trace.activate():
+                await check.prepare()
         except Exception as e:
             log.exception(e)
-        # remove the message from the SQS queue
-        r = await sqs.delete_message(
-            QueueUrl=QUEUE_URL,
-            ReceiptHandle=receipt_handle,
-        )
-        log.info(f"worker {n} deleting {receipt_handle=} {r=}")
-        queue.task_done()
+            # skip the remaining stages
+            check.error = e
+        if check.error is None:
+            load.record("prepare", time() - started_at)
+        await prepared.put(job)
+
+
+async def worker(n, prepared, registry, prefetch, load, index):
+    while True:
+        # dequeue a prepared "work item"
+        job = await prepared.get()
+        check = job.check
+        log.info(f"worker {n} got {check.spec_d=}")
+        load.start_capture()
+        started_at = time()
+        try:
+            with check.trace.activate():
+                await check.capture()
+        except Exception as e:
+            log.exception(e)
+        load.end_capture()
+        # failed and cancelled checks say little about how long checks take
+        if check.error is None:
+            load.record("capture", time() - started_at)
+        if check.report_d is not None:
+            try:
+                index.add(check.report_d)
+            except Exception as e:
+                log.exception(e)
+        prefetch.release()
+        registry.remove(job)
+        # remove the message from its SQS queue
+        with check.trace.activate():
+            await job.done()
+        check.trace.end()
+        prepared.task_done()
+
+
+async def handle_message(registry, publisher, job_queue, m):
+    """Turn a message from a job queue into a Job, or act on a cancellation"""
+    msg = json.loads(m["Body"])
+    spec_d = json.loads(msg["Message"])
+    log.debug(f"got {spec_d=} from {job_queue.name}")
+    receipt_handle = m["ReceiptHandle"]
+    if spec_d.get("action") == "cancel":
+        await registry.cancel(spec_d["check_id"])
+        await job_queue.delete(receipt_handle)
+        return None
+    if registry.redelivered(spec_d["check_id"], receipt_handle):
+        return None
+    sent_at = int(m.get("Attributes", {}).get("SentTimestamp", time() * 1000)) / 1000
+    check = CheckRequest(spec_d, partial(publisher.publish, spec_d), sent_at=sent_at)
+    job = Job(job_queue, check, receipt_handle, sent_at)
+    # supersedes any older check of the same story
+    await registry.add(job)
+    return job
+
+
+async def log_queue_stats(scheduler):
+    while True:
+        await asyncio.sleep(QUEUE_STATS_SECS)
+        log.info(f"queue stats {json.dumps(scheduler.summary())}")
+
+
+class Startup(object):
+    """Seconds from STARTED_AT to each phase of starting up"""
+
+    def __init__(self):
+        self.marks = {}
+
+    def mark(self, phase):
+        self.marks[phase] = round(time() - STARTED_AT, 3)
+        if STARTUP_PROFILE:
+            log.info(f"startup {phase} after {self.marks[phase]} seconds")
+
+    async def wait_for_polling(self, job_queues):
+        waits = [asyncio.create_task(q.polling.wait()) for q in job_queues]
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for wait in waits:
+                wait.cancel()
+        self.mark("first_receive")
+
+
+def get_prewarm_cmds():
+    registry = f" --registry {NPM_REGISTRY}" if NPM_REGISTRY is not None else ""
+    cmds = {"npm": f"npm cache add storycap{registry}", "browser": PREWARM_BROWSER_CMD}
+    return [cmds[name.strip()] for name in PREWARM.split(",") if name.strip()]
+
+
+async def prewarm(startup):
+    """Run the PREWARM commands alongside the first poll so the first check
+    doesn't pay for a cold npm cache and browser"""
+    procs = Processes(gettempdir() / "prewarm")
+    try:
+        for r in await asyncio.gather(*(procs.run(cmd) for cmd in get_prewarm_cmds())):
+            if r.returncode != 0:
+                log.info(f"prewarm failed {r.cmd=} {r.returncode=} {r.stderr=}")
+    except asyncio.CancelledError:
+        procs.kill()
+        raise
+    startup.mark("prewarm")
 
 
 async def poll_queue():
+    startup = Startup()
+    startup.mark("imports")
+    # look up the job queues while the clients are created
+    configs = asyncio.create_task(asyncio.to_thread(get_queue_configs, QUEUE_MAX_IN_FLIGHT))
     session = get_session()
-    # create a queue that we will use to store our "workload"
-    queue = asyncio.Queue(maxsize=MAX_QUEUE_MESSAGES)
-
-    tasks = []
-    # storybook seems not to like concurrency
-    for n in range(1):
-        task = asyncio.create_task(worker(n, queue))
-        tasks.append(task)
+    # checks ready to capture
+    prepared = asyncio.Queue()
+    storage = get_storage()
+    registry = CheckRegistry(storage)
+    load = Load(MAX_QUEUE_MESSAGES, WAIT_TIME, PREFETCH_DEPTH, PREFETCH_MAX_DEPTH)
+    prefetch = Prefetch(load)
+    index = ResultsIndex(INDEX_PATH)
+    index_sync = IndexSync(index, storage)
 
     async with session.create_client("sqs") as sqs, session.create_client("sns") as sns:
-        while True:
-            try:
-                log.info("receiving messages")
-                # grab a message from the SQS queue
-                r = await sqs.receive_message(
-                    QueueUrl=QUEUE_URL,
-                    WaitTimeSeconds=WAIT_TIME,
-                    MaxNumberOfMessages=MAX_QUEUE_MESSAGES,
-                )
-                # queue up the asyncio queue for the workers to process
-                for m in r.get("Messages", []):
-                    msg = json.loads(m["Body"])
-                    spec_d = json.loads(msg["Message"])
-                    log.debug(f"got {spec_d=}")
-                    receipt_handle = m["ReceiptHandle"]
-                    # if the queue is full, wait until a free slot is available
-                    await queue.put((sqs, sns, spec_d, receipt_handle))
-
-            except KeyboardInterrupt:
-                break
-
-            except asyncio.CancelledError:
-                log.info(f"received signal ({ECS_SIG_CANCEL.name}), shutting down")
-                break
-
-    # Gracefully shutdown any running tasks
-    if any([not task.done() for task in tasks]):
-        # Wait TASK_SHUTDOWN_SECS for running tasks to complete their work.
-        log.info(f"waiting {TASK_SHUTDOWN_SECS} for running tasks to complete")
-        _, pending = await asyncio.wait({*tasks}, timeout=TASK_SHUTDOWN_SECS)
+        # status updates go out in the background
+        publisher = StatusPublisher(sns).start()
+        startup.mark("clients")
+        job_queues = [JobQueue(sqs, **config) for config in await configs]
+        startup.mark("queues")
+        scheduler = FairScheduler(job_queues)
+
+        tasks = [
+            asyncio.create_task(prefetcher(scheduler, prepared, prefetch, load)),
+            asyncio.create_task(log_queue_stats(scheduler)),
+            asyncio.create_task(load.run(job_queues)),
+            asyncio.create_task(index_sync.run()),
+            asyncio.create_task(prewarm(startup)),
+            asyncio.create_task(startup.wait_for_polling(job_queues)),
+            *[asyncio.create_task(q.heartbeat()) for q in job_queues],
+        ]
+        # storybook seems not to like concurrency
+        for n in range(1):
+            task = asyncio.create_task(worker(n, prepared, registry, prefetch, load, index))
+            tasks.append(task)
+
+        # a poller per job queue, each receiving only while its queue has room
+        handle = partial(handle_message, registry, publisher)
+        pollers = [asyncio.create_task(q.poll(handle, scheduler, load)) for q in job_queues]
+        try:
+            await asyncio.gather(*pollers)
+        except KeyboardInterrupt:
+            pass
+        except asyncio.CancelledError:
+            log.info(f"received signal ({ECS_SIG_CANCEL.name}), shutting down")
+        for poller in pollers:
+            poller.cancel()
+        await asyncio.gather(*pollers, return_exceptions=True)
 
-        # cancel our worker tasks after waiting
-        for task in pending:
-            log.info(f"cancelling task ({task.get_name()}) after {TASK_SHUTDOWN_SECS} seconds")
+        # Gracefully shutdown while the clients are still open. Wait
+        # TASK_SHUTDOWN_SECS for the checks already received to complete.
+        shutdown_at = time()
+        log.info(f"waiting {TASK_SHUTDOWN_SECS} for running tasks to complete")
+        try:
+            await asyncio.wait_for(registry.drained(), TASK_SHUTDOWN_SECS)
+        except asyncio.TimeoutError:
+            log.info(f"cancelling tasks after {TASK_SHUTDOWN_SECS} seconds")
+        log.info(f"queue stats {json.dumps(scheduler.summary())}")
+        await index_sync.sync()
+        # the workers wait for more checks forever
+        for task in tasks:
             task.cancel()
-    await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # let other workers take the checks that didn't get to complete
+        for job_queue in job_queues:
+            try:
+                await job_queue.release()
+            except Exception as e:
+                log.exception(e)
+        # flush the status updates in whatever is left of TASK_SHUTDOWN_SECS
+        await publisher.close(max(0, TASK_SHUTDOWN_SECS - (time() - shutdown_at)))
+        await asyncio.to_thread(flush)
 
     log.info("done")
 
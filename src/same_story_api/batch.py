@@ -0,0 +1,116 @@
+"""Run a batch of checks on this machine, without AWS.
+
+    python src/same_story_api/batch.py specs.jsonl --storage-dir reports
+
+Each line of specs.jsonl is a check specification, as published to the job
+topic, plus "frame", the path of its Figma check frame PNG. A check_id is made
+up for any specification without one. Reports are written to
+<storage-dir>/checks/<check_id>/report and a summary line per check is written
+to --output. The results are also indexed in <storage-dir>/index/batch.sqlite,
+for Client(LocalStorage(<storage-dir>)).get_history and get_trend.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from uuid import uuid4
+
+from helpful_scripts import LocalStorage, ResultsIndex, log
+
+
+def run_check(spec_d, storage_dir):
+    """Run one check in a worker process and return its results.json"""
+    os.environ["STORAGE"] = "local"
+    os.environ["STORAGE_DIR"] = storage_dir
+    from check import CheckRequest
+    from tracing import flush
+
+    storage = LocalStorage(storage_dir)
+
+    async def log_status(msg):
+        log.info(f"{msg['check_id']} {msg.get('message') or msg.get('error')}")
+
+    asyncio.run(CheckRequest(spec_d, log_status, storage=storage).run())
+    flush()
+    return json.loads(storage.get(f"checks/{spec_d['check_id']}/report/results.json"))
+
+
+def read_specs(path, storage):
+    """Read the specifications and put their frames in storage, yielding each
+    with the error that kept its frame out of storage, if any"""
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            spec_d = json.loads(line)
+            spec_d.setdefault("check_id", str(uuid4()))
+            key = f"checks/{spec_d['check_id']}/frames/{spec_d.get('story')}.png"
+            try:
+                storage.upload_file(spec_d.pop("frame"), key)
+            except (KeyError, OSError) as e:
+                log.error(f"no frame for {spec_d['check_id']} {e=}")
+                yield spec_d, e
+                continue
+            yield spec_d, None
+
+
+def summarize(results):
+    summary = {key: results.get(key) for key in ("check_id", "repository", "component", "story")}
+    if "error" in results:
+        summary["error"] = results["error"]
+    else:
+        for key in ("MAE", "mae", "ssim", "diff_pixels_pct", "created_at", "completed_at"):
+            summary[key] = results.get(key)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n")[0],
+        epilog=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("specs", help="JSONL file of check specifications")
+    parser.add_argument("--storage-dir", default="same-story-storage")
+    parser.add_argument("--output", default="-", help="where to write the summary (JSONL)")
+    # storycap doesn't seem to like running more than one job at a time
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    storage = LocalStorage(args.storage_dir)
+    index = ResultsIndex(storage.path("index/batch.sqlite"))
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    checks = failed = 0
+
+    def write(summary):
+        nonlocal failed
+        failed += "error" in summary
+        output.write(json.dumps(summary) + "\n")
+        output.flush()
+
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = {}
+        for spec_d, error in read_specs(args.specs, storage):
+            checks += 1
+            if error is not None:
+                # the check can't run without its frame, but the others can
+                write(summarize({**spec_d, "error": {"frame": repr(error)}}))
+                continue
+            futures[pool.submit(run_check, spec_d, str(storage.directory))] = spec_d
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+                index.add(results)
+                summary = summarize(results)
+            except Exception as e:
+                log.exception(e)
+                summary = {"check_id": futures[future]["check_id"], "error": repr(e)}
+            write(summary)
+    log.info(f"{checks} checks, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,25 +3,55 @@ import gettext
 import json
 import os
 import sys
-from pathlib import Path
+from contextlib import ExitStack, asynccontextmanager
 from shlex import quote as sh_quote
 from time import time
 from urllib.parse import quote
 
+from compare import TILED_COMPARE_MIN_PIXELS, CompareError, compare_images, identify
 from engi_helpful_scripts.git import (
     get_git_secrets,
     git_sync,
     github_checkout,
     is_git_secrets,
 )
-from engi_helpful_scripts.run import CmdError, run, set_directory
-from helpful_scripts import cleanup_directory, get_port, get_s3_url, log, make_s3_public
+from engi_helpful_scripts.run import CmdError, set_directory
+from helpful_scripts import (
+    cleanup_directory,
+    get_cancel_key,
+    get_latest,
+    get_port,
+    get_storage,
+    gettempdir,
+    log,
+)
+from procs import CmdExit, Processes, truncate
+from storybook import BuildCache, StaticServer, get_build_key, get_storycap_version
+from tracing import CLIENT, Profiler, Trace, flush, span
 
 _ = gettext.gettext
 
 
-BUCKET_NAME = os.environ["BUCKET_NAME"]
 NPM_REGISTRY = os.environ.get("NPM_REGISTRY")
+# capture from a static build-storybook build, cached per repository, commit and
+# lockfile, rather than the start-storybook dev server, unless the spec says
+# otherwise with static_build
+STATIC_BUILD = os.environ.get("STATIC_BUILD", "0")
+
+# the git helpers work in the current directory, which is shared by every check
+# in the process, so they take turns. Everything else is given absolute paths or
+# an explicit cwd so that a check can be prepared while another one captures.
+_cwd_lock = None
+
+
+@asynccontextmanager
+async def in_directory(path):
+    global _cwd_lock
+    if _cwd_lock is None:
+        _cwd_lock = asyncio.Lock()
+    async with _cwd_lock:
+        with set_directory(path):
+            yield
 
 
 class CheckError(Exception):
@@ -32,14 +62,20 @@ class CheckError(Exception):
         "commit": _("failed to checkout commit in GitHub repo"),
         "install": _("npm install failed"),
         "storycap": _("storycap failed"),
+        "build": _("build-storybook failed"),
         "aws": _("internal AWS error"),
         "comp": _("failed to generate visual comparison"),
+        "cancelled": _("check cancelled"),
+        "superseded": _("check superseded by a newer check of the same story"),
     }
 
-    def __init__(self, e_key, stdout=None, stderr=None):
+    def __init__(self, e_key, stdout=None, stderr=None, log_path=None, **details):
         self.e_key = e_key
         self.stdout = stdout
         self.stderr = stderr
+        self.log_path = log_path
+        # any extra fields for the client, e.g. the check_id that superseded this one
+        self.details = details
 
     def __str__(self):
         return CheckError.messages[self.e_key]
@@ -50,14 +86,11 @@ class CheckError(Exception):
                 self.e_key: str(self),
                 "stdout": self.stdout,
                 "stderr": self.stderr,
+                **self.details,
             }
         }
 
 
-async def run_seq(funcs):
-    [await f() for f in funcs]
-
-
 def head(path, n=5):
     """Return the first n lines of file path"""
     snippet = ""
@@ -68,8 +101,14 @@ def head(path, n=5):
 
 
 def raise_or_return(cmd_exit, returncode=0, e_key=None):
+    stdout, stderr = cmd_exit.stdout, cmd_exit.stderr
+    # keep status messages and results.json small: the output of Processes is
+    # already bounded, with the full output in the log at log_path, but not
+    # that of the git helpers
+    if not isinstance(cmd_exit, CmdExit):
+        stdout, stderr = truncate(stdout), truncate(stderr)
     error = (
-        CheckError(e_key, cmd_exit.stdout, cmd_exit.stderr)
+        CheckError(e_key, stdout, stderr, log_path=getattr(cmd_exit, "log_path", None))
         if returncode != cmd_exit.returncode
         else None
     )
@@ -89,18 +128,79 @@ class CheckRequest(object):
         _("completed numeric comparisons"),
         _("uploaded screenshots"),
     ]
-    PUBLIC_ACL_ARGS = "--acl public-read"
+    # the stages worth checking for cancel and supersede markers before, as
+    # each check costs a few storage requests
+    MARKED_STAGES = {
+        "install_packages",
+        "build_storybook",
+        "run_storycap",
+        "run_visual_comparisons",
+        "run_numeric_comparisons",
+    }
 
-    def __init__(self, spec_d, status_callback):
-        log.info(f"{BUCKET_NAME=}")
+    def __init__(self, spec_d, status_callback, storage=None, sent_at=None):
+        self.storage = storage or get_storage()
+        log.info(f"{self.storage=}")
         log.info(f"{NPM_REGISTRY=}")
         self.spec_d = spec_d
+        # when the check was sent to its job queue, to tell which of two checks
+        # of a story is newer, or None if it didn't come from a queue
+        self.sent_at = sent_at
         self.results_d = {}
+        self.results = "results.json"
+        # the contents of results.json once it has been written
+        self.report_d = None
         self.status_callack = status_callback
-        self.prefix = Path(f"{BUCKET_NAME}/checks/{spec_d['check_id']}")
-        self.check_dir = gettempdir() / self.prefix
+        self.prefix = f"checks/{spec_d['check_id']}"
+        self.check_dir = gettempdir() / self.storage.name / self.prefix
         self.check_dir.mkdir(parents=True, exist_ok=True)
+        self.code = self.check_dir / "code"
+        self.node_modules = self.code / "node_modules"
         self.step = 0
+        self.comparison = None
+        self.log_dir = self.check_dir / "logs"
+        self.storybook_static = self.check_dir / "storybook-static"
+        # set once storybook_static holds the build to capture from
+        self.static_build = None
+        self.build_key = None
+        self.procs = Processes(self.log_dir)
+        self.cancelled = None
+        self.error = None
+        self.trace = Trace(spec_d["check_id"])
+
+    def cancel(self, e_key="cancelled", **details):
+        """Cancel the check: kill its running subprocesses and stop before the
+        next stage. The check finishes with a terminal error status e_key."""
+        log.info(f"cancelling {self.spec_d['check_id']} {e_key=} {details=}")
+        self.cancelled = CheckError(e_key, **details)
+        self.procs.kill()
+
+    async def check_markers(self):
+        """Cancel the check if any worker received a cancel for it, or a newer
+        check of the same story. A missing or older latest marker, or one that
+        can't be read, leaves the check running."""
+        if self.cancelled or self.sent_at is None:
+            return
+        check_id = self.spec_d["check_id"]
+        try:
+            if await asyncio.to_thread(self.storage.exists, get_cancel_key(check_id)):
+                self.cancel("cancelled")
+                return
+            latest = await asyncio.to_thread(get_latest, self.storage, self.spec_d)
+        except Exception as e:
+            log.exception(e)
+            return
+        if latest is not None and latest["sent_at"] > self.sent_at:
+            self.cancel("superseded", superseded_by=latest["check_id"])
+
+    async def run_seq(self, funcs):
+        for f in funcs:
+            if f.__name__ in self.MARKED_STAGES:
+                await self.check_markers()
+            if self.cancelled:
+                raise self.cancelled
+            with span(f.__name__):
+                await f()
 
     async def send_status(self, error=None):
         msg = {
@@ -117,21 +217,16 @@ class CheckRequest(object):
         await self.status_callack(msg)
 
     async def download(self):
-        await self.run_raise(
-            f"aws s3 cp s3://{self.prefix} {self.check_dir} --recursive", e_key="aws"
-        )
+        await self.store(self.storage.download_dir, self.prefix, self.check_dir)
         self.repo = self.spec_d["repository"]
-        self.code = self.check_dir / "code"
-        self.node_modules = self.code / "node_modules"
-        self.results = "results.json"
         self.story = self.spec_d["story"]
         frame = f"frames/{self.story}.png"
         self.frame = self.check_dir / frame
         if self.frame.exists():
             frame_full = f"{self.prefix}/{frame}"
             error = None
-            make_s3_public(frame_full)
-            self.results_d["url_check_frame"] = get_s3_url(quote(frame_full))
+            await self.store(self.storage.make_public, frame_full)
+            self.results_d["url_check_frame"] = self.storage.get_url(quote(frame_full))
         else:
             error = CheckError("frame", stderr=str(f"failed to download {frame}"))
         await self.send_status(error=error)
@@ -152,24 +247,31 @@ class CheckRequest(object):
         branch = self.spec_d.get("branch")
         commit = self.spec_d.get("commit")
         try:
-            await git_sync(branch, commit)
+            async with in_directory(self.code):
+                await git_sync(branch, commit)
         except CmdError as e:
             raise_or_return(e.cmd_exit, e_key="branch" if branch in e.cmd else "commit")
+        # the full SHA of what was checked out, the spec may have a short SHA or
+        # none for the head of the branch
+        cmd_exit = await self.procs.run("git rev-parse HEAD", cwd=self.code)
+        raise_or_return(cmd_exit, e_key="commit")
+        self.results_d["head_commit"] = cmd_exit.stdout.strip()
         self.get_code_snippets()
         self.get_code_size()
         await self.send_status()
 
     async def reveal_secrets(self):
         # if this repo contains git secrets reveal them
-        if await is_git_secrets():
-            await get_git_secrets()
+        async with in_directory(self.code):
+            if await is_git_secrets():
+                await get_git_secrets()
 
     def get_code_snippets(self):
         code_snippets = []
         code_paths = []
         # the storybook source might be a .jsx or .tsx file
-        for p in Path("./").rglob(f"*/{self.spec_d['component']}*.[jt]sx"):
-            code_paths.append(str(p))
+        for p in self.code.rglob(f"*/{self.spec_d['component']}*.[jt]sx"):
+            code_paths.append(str(p.relative_to(self.code)))
             code_snippets.append(head(p))
 
         self.results_d.update({"code_paths": code_paths, "code_snippets": code_snippets})
@@ -179,17 +281,80 @@ class CheckRequest(object):
             f.stat().st_size for f in self.code.glob("**/*") if f.is_file()
         )
 
+    def use_static_build(self):
+        static = self.spec_d.get("static_build", STATIC_BUILD)
+        return str(static).lower() in ("1", "true", "yes")
+
+    def get_build_cache(self):
+        return BuildCache(self.storage, gettempdir() / "storybook-builds")
+
+    async def fetch_static_build(self):
+        """Use the cached build of this commit and packages, if there is one"""
+        if not self.use_static_build():
+            return
+        self.build_key = get_build_key(self.repo, self.results_d["head_commit"], self.code)
+        if self.build_key is None:
+            log.info("no lockfile, not caching the static build")
+            return
+        cache = self.get_build_cache()
+        if await self.store(cache.fetch, self.build_key, self.storybook_static):
+            log.info(f"using cached static build {self.build_key}")
+            self.static_build = self.storybook_static
+            self.results_d["static_build"] = "cached"
+
     async def install_packages(self):
+        if self.static_build is not None:
+            # the build is all storycap needs
+            await self.send_status()
+            return
         if NPM_REGISTRY is not None:
-            await self.run_raise(f"npm set registry {NPM_REGISTRY}", e_key="install")
-        await self.run_raise("npm install", e_key="install")
+            await self.run_raise(f"npm set registry {NPM_REGISTRY}", e_key="install", cwd=self.code)
+        await self.run_raise("npm install", e_key="install", cwd=self.code)
         await self.send_status()
 
-    def get_dims(self):
+    async def build_storybook(self):
+        if not self.use_static_build() or self.static_build is not None:
+            return
+        await self.run_raise(
+            f"npx build-storybook --quiet -o {sh_quote(str(self.storybook_static))}",
+            e_key="build",
+            cwd=self.code,
+        )
+        self.static_build = self.storybook_static
+        self.results_d["static_build"] = "built"
+        if self.build_key is not None:
+            try:
+                await self.store(self.get_build_cache().put, self.build_key, self.storybook_static)
+            except CheckError as e:
+                # the check can go ahead without caching the build
+                log.error(f"failed to cache the static build {e.stderr=}")
+
+    def get_viewport(self):
         height = int(self.spec_d.get("height", "600"))
         width = int(self.spec_d.get("width", "800"))
+        return width, height
+
+    def get_dims(self):
+        width, height = self.get_viewport()
         return f"--viewport {width}x{height}"
 
+    async def use_tiled_compare(self):
+        """Compare large images band by band to keep memory bounded. Full-page
+        screenshots and frames can be much taller than the viewport, so this
+        goes by the size of the images themselves. The spec can force either
+        mode with tiled_compare."""
+        tiled = self.spec_d.get("tiled_compare")
+        if tiled is not None:
+            return str(tiled).lower() in ("1", "true", "yes")
+        try:
+            sizes = [await identify(path) for path in (self.screenshot, self.frame)]
+        except CompareError as e:
+            error = CheckError("comp", stderr=str(e))
+            await self.send_status(error=error)
+            raise error
+        width, height = max(w for w, _ in sizes), max(h for _, h in sizes)
+        return width * height >= TILED_COMPARE_MIN_PIXELS
+
     def get_query(self):
         def get(key):
             return self.spec_d[key].lower().replace(" ", "-").replace("/", "-")
@@ -222,12 +387,29 @@ class CheckRequest(object):
         return f"__screenshots__/{self.get_include(quote=quote)}.png"
 
     async def run_storycap(self):
-        port = get_port()
-        await self.run_raise(
-            f"npx storycap http://localhost:{port} {self.get_dims()} {self.get_timeout()} "
-            f"{self.get_query()} {self.get_story_include()} --serverCmd 'start-storybook -p {port}'",
-            e_key="storycap",
-        )
+        if self.static_build is not None:
+            # npm install may have been skipped, so storycap may not be installed:
+            # run the version the repository would have installed
+            version = get_storycap_version(self.code)
+            if version is None:
+                log.info("storycap isn't pinned, running the latest")
+            storycap = sh_quote(f"storycap@{version}" if version else "storycap")
+            with StaticServer(self.static_build) as server:
+                await self.run_raise(
+                    f"npx --yes {storycap} {server.url} {self.get_dims()} {self.get_timeout()} "
+                    f"{self.get_query()} {self.get_story_include()}",
+                    e_key="storycap",
+                    cwd=self.code,
+                )
+        else:
+            port = get_port()
+            await self.run_raise(
+                f"npx storycap http://localhost:{port} {self.get_dims()} {self.get_timeout()} "
+                f"{self.get_query()} {self.get_story_include()} "
+                f"--serverCmd 'start-storybook -p {port}'",
+                e_key="storycap",
+                cwd=self.code,
+            )
 
         screenshot = self.get_screenshot(quote=lambda x: x)
         self.screenshot = self.code / screenshot
@@ -237,22 +419,48 @@ class CheckRequest(object):
                 stderr=f"storycap ran successfully but expected screenshot {screenshot} wasn't created",
             )
 
-        await self.run_raise(
-            f"aws s3 cp {self.code}/__screenshots__ "
-            f"s3://{self.prefix}/report/__screenshots__ --recursive {self.PUBLIC_ACL_ARGS}",
-            e_key="aws",
+        await self.store(
+            self.storage.upload_dir,
+            self.code / "__screenshots__",
+            f"{self.prefix}/report/__screenshots__",
+            public=True,
         )
         self.results_d["url_screenshot"] = self.get_url(self.get_screenshot())
 
         await self.send_status()
 
     async def run_visual_comparisons(self):
-        self.gray_difference = Path("gray_difference.png")
+        self.gray_difference = self.code / "gray_difference.png"
+        self.blue_difference = self.code / "blue_difference.png"
+        if await self.use_tiled_compare():
+            await self.run_tiled_comparisons()
+        else:
+            await self.run_imagemagick_comparisons()
+
+        for f in self.blue_difference, self.gray_difference:
+            await self.store(
+                self.storage.upload_file, f, f"{self.prefix}/report/{f.name}", public=True
+            )
+            self.results_d[f"url_{f.stem}"] = self.get_url(f.name)
+
+        await self.send_status()
+
+    async def run_tiled_comparisons(self):
+        try:
+            self.comparison = await compare_images(
+                self.screenshot, self.frame, self.gray_difference, self.blue_difference
+            )
+        except CompareError as e:
+            error = CheckError("comp", stderr=str(e))
+            await self.send_status(error=error)
+            raise error
+
+    async def run_imagemagick_comparisons(self):
         await self.run_raise(
             f"convert '{self.screenshot}' -flatten -grayscale Rec709Luminance "
             f"'{self.frame}' -flatten -grayscale Rec709Luminance "
             "-clone 0-1 -compose darken -composite "
-            f"-channel RGB -combine {self.gray_difference}",
+            f"-channel RGB -combine '{self.gray_difference}'",
             e_key="comp",
         )
         error = (
@@ -264,12 +472,10 @@ class CheckRequest(object):
             await self.send_status(error=error)
             raise error
 
-        self.blue_difference = Path("blue_difference.png")
         # compare exits with code 1 even though it seems to have run successfully
-        await run(
+        await self.procs.run(
             f"compare '{self.screenshot}' '{self.frame}' "
-            f"-highlight-color blue {self.blue_difference}",
-            raise_code=None,
+            f"-highlight-color blue '{self.blue_difference}'"
         )
         error = (
             None
@@ -280,87 +486,167 @@ class CheckRequest(object):
             await self.send_status(error=error)
             raise error
 
-        for f in self.blue_difference, self.gray_difference:
-            key = str(f).split(".")[0]
-            await self.run_raise(
-                f"aws s3 cp {f} s3://{self.prefix}/report/{f} {self.PUBLIC_ACL_ARGS}",
-                e_key="aws",
-            )
-            self.results_d[f"url_{key}"] = self.get_url(f)
-
-        await self.send_status()
-
     async def run_numeric_comparisons(self):
-        # compare exits with code 1 even though it seems to have run successfully
-        cmd_exit = await run(
-            f"compare -metric MAE '{self.screenshot}' '{self.frame}' null", raise_code=None
-        )
-        self.results_d["MAE"] = cmd_exit.stderr.strip()
+        """MAE, SSIM, changed pixels and regions from the same single pass
+        whatever the viewport size, so they can be compared across checks. MAE
+        is also given in the format of compare -metric MAE."""
+        if self.comparison is None:
+            try:
+                self.comparison = await compare_images(self.screenshot, self.frame)
+            except CompareError as e:
+                error = CheckError("comp", stderr=str(e))
+                await self.send_status(error=error)
+                raise error
+        self.results_d.update(self.comparison)
         await self.send_status()
 
     def get_url(self, path_quoted):
-        return get_s3_url(f"{self.prefix}/report/{path_quoted}")
+        return self.storage.get_url(f"{self.prefix}/report/{path_quoted}")
 
     async def upload(self):
         self.results_d["completed_at"] = time()
         duration = self.results_d["completed_at"] - self.results_d["created_at"]
         log.info(f"check done {duration} seconds")
-        json.dump(
-            {
-                **self.spec_d,
-                **self.results_d,
-            },
-            open(self.results, "w"),
-        )
-        await self.run_raise(
-            f"aws s3 cp {self.results} s3://{self.prefix}/report/{self.results}", e_key="aws"
-        )
+        await self.write_results({**self.spec_d, **self.results_d})
         await self.send_status()
 
     async def df(self):
         await self.run_raise(f"df -h {gettempdir()}")
 
     async def run(self):
+        with self.trace.activate():
+            await self.prepare()
+            await self.capture()
+        self.trace.end()
+
+    async def prepare(self):
+        """The I/O bound stages that don't need the browser, so they can run for
+        the next check while the current one captures"""
+        self.results_d["created_at"] = time()
+        await self.run_stages(
+            [
+                self.df,
+                self.send_status,
+                self.download,
+                self.run_git,
+                self.sync_repo,
+                self.reveal_secrets,
+                self.fetch_static_build,
+                self.install_packages,
+            ]
+        )
+
+    async def capture(self):
+        async with Profiler(self.check_dir) as profiler:
+            await self.run_stages(
+                [
+                    # CPU bound like the capture, so not run while the check
+                    # before this one captures
+                    self.build_storybook,
+                    self.run_storycap,
+                    self.run_visual_comparisons,
+                    self.run_numeric_comparisons,
+                    self.upload,
+                ],
+                last=True,
+            )
+        await self.upload_profile(profiler)
+
+    async def run_stages(self, funcs, last=False):
+        """Run funcs in order, skipping them if an earlier stage failed. The
+        node_modules directory is too big to persist, so it is deleted after the
+        last stages, whether or not the check failed, along with the logs and
+        the static build."""
+        with ExitStack() as stack:
+            if last:
+                for path in self.node_modules, self.log_dir, self.storybook_static:
+                    stack.enter_context(cleanup_directory(path))
+            if self.error:
+                return
+            try:
+                await self.run_seq(funcs)
+            except CheckError as e:
+                self.error = e
+                await self.report_error(e)
+
+    async def report_error(self, e):
+        if self.cancelled:
+            # whatever failed was killed by the cancellation, report that
+            # instead with processes that are allowed to run
+            e = self.cancelled
+            self.procs = Processes(self.log_dir)
+        await self.upload_log(e)
+        log.exception(e)
+        d = {**self.spec_d, **e.to_dict()}
+        log.error(f"{d=}")
+        await self.write_results(d)
+        await self.send_status(error=e)
+
+    async def write_results(self, d):
+        results_file = self.check_dir / self.results
+        json.dump(d, open(results_file, "w"))
+        await self.store(
+            self.storage.upload_file, results_file, f"{self.prefix}/report/{self.results}"
+        )
+        self.report_d = d
+
+    async def upload_log(self, e):
+        """Upload the full output of the command that failed and reference it
+        from the error"""
+        if e.log_path is None or not e.log_path.exists():
+            return
+        log_key = f"logs/{e.e_key}-{e.log_path.name}"
         try:
-            self.results_d["created_at"] = time()
-            await run_seq([self.df, self.send_status, self.download, self.run_git])
-            with set_directory(self.code):
-                # delete the node_modules directory; it's too big to persist
-                with cleanup_directory(self.node_modules):
-                    await run_seq(
-                        [
-                            self.sync_repo,
-                            self.reveal_secrets,
-                            self.install_packages,
-                            self.run_storycap,
-                            self.run_visual_comparisons,
-                            self.run_numeric_comparisons,
-                            self.upload,
-                        ]
-                    )
-        except CheckError as e:
-            log.exception(e)
-            results_file = self.check_dir / self.results
-            d = {**self.spec_d, **e.to_dict()}
-            log.error(f"{d=}")
-            json.dump(d, open(results_file, "w"))
-            await self.run_raise(
-                f"aws s3 cp {results_file} s3://{self.prefix}/report/{self.results}"
+            await self.store(
+                self.storage.upload_file,
+                e.log_path,
+                f"{self.prefix}/report/{log_key}",
+                public=True,
+                content_type="text/plain",
+                content_encoding="gzip",
             )
-            await self.send_status(error=e)
+        except CheckError as upload_error:
+            log.error(f"failed to upload {e.log_path} {upload_error.stderr=}")
+            return
+        e.details["log_url"] = self.get_url(log_key)
+
+    async def upload_profile(self, profiler):
+        if profiler.path is None:
+            return
+        key = f"profile/{profiler.path.name}"
+        try:
+            await self.store(
+                self.storage.upload_file, profiler.path, f"{self.prefix}/report/{key}", public=True
+            )
+        except CheckError as e:
+            log.error(f"failed to upload {profiler.path} {e.stderr=}")
+            return
+        self.trace.set(profile_url=self.get_url(key))
+
+    async def store(self, method, *args, **kwargs):
+        """Run a blocking storage operation off the event loop, failing the
+        check with an aws error"""
+        with span(f"storage.{method.__name__}", CLIENT, storage=self.storage.name):
+            try:
+                return await asyncio.to_thread(method, *args, **kwargs)
+            except Exception as e:
+                raise CheckError("aws", stderr=f"{method.__name__} failed: {e!r}")
 
-    async def run_raise(self, cmd, returncode=0, e_key=None, log_cmd=None):
-        cmd_exit = await run(cmd, log_cmd=log_cmd, raise_code=None)
+    async def run_raise(self, cmd, returncode=0, e_key=None, log_cmd=None, cwd=None):
+        cmd_exit = await self.procs.run(cmd, log_cmd=log_cmd, cwd=cwd)
         return raise_or_return(cmd_exit, returncode, e_key)
 
 
-def gettempdir():
-    # return tempfile.gettempdir()
-    return Path(os.environ.get("TMPDIR", "/tmp/"))
+async def log_status(msg):
+    log.info(f"{msg=}")
 
 
 async def main():
-    await CheckRequest(sys.argv[1]).run()
+    """Run a single check: check.py specification.json"""
+    with open(sys.argv[1]) as fp:
+        spec_d = json.load(fp)
+    await CheckRequest(spec_d, log_status).run()
+    await asyncio.to_thread(flush)
 
 
 if __name__ == "__main__":
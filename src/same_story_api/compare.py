@@ -0,0 +1,441 @@
+import asyncio
+import filecmp
+import heapq
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from helpful_scripts import log
+
+# number of pixel rows of each image held in memory at any one time
+BAND_ROWS = int(os.environ.get("COMPARE_BAND_ROWS", 256))
+# images with at least this many pixels are compared band by band
+TILED_COMPARE_MIN_PIXELS = int(os.environ.get("TILED_COMPARE_MIN_PIXELS", 4_000_000))
+# compare -metric MAE reports the absolute error scaled to the ImageMagick (Q16)
+# quantum range followed by the normalized error in parentheses
+QUANTUM_RANGE = 65535
+# sRGB <-> linear lookup tables for Rec709Luminance grayscale conversion
+SRGB = np.arange(256) / 255
+LINEAR = np.where(SRGB <= 0.04045, SRGB / 12.92, ((SRGB + 0.055) / 1.055) ** 2.4)
+REC709 = np.array([0.2126, 0.7152, 0.0722])
+# faded background and highlight used for the blue difference, like compare
+LOWLIGHT = 0.8
+HIGHLIGHT = np.array([0, 0, 255], dtype=np.uint8)
+# side in pixels of the blocks used for SSIM windows and changed regions
+BLOCK = 8
+# SSIM stabilizing constants for 8-bit pixels
+C1 = (0.01 * 255) ** 2
+C2 = (0.03 * 255) ** 2
+# a pixel is counted as changed when a channel differs by more than this
+DIFF_THRESHOLD = int(os.environ.get("DIFF_THRESHOLD", 0))
+# report at most this many changed regions, largest first
+MAX_DIFF_REGIONS = int(os.environ.get("MAX_DIFF_REGIONS", 50))
+
+
+class CompareError(Exception):
+    pass
+
+
+async def identify(path):
+    """Return the (width, height) of the image at path without decoding it"""
+    proc = await asyncio.create_subprocess_exec(
+        "identify",
+        "-ping",
+        "-format",
+        "%w %h",
+        str(path),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise CompareError(stderr.decode())
+    width, height = stdout.decode().split()
+    return int(width), int(height)
+
+
+class BandReader(object):
+    """Stream the pixels of an image as RGBA rows with ImageMagick's stream
+    command, which decodes the image a few rows at a time instead of loading it
+    all into memory."""
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_read = 0
+
+    async def __aenter__(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            "stream",
+            "-map",
+            "rgba",
+            "-storage-type",
+            "char",
+            str(self.path),
+            "-",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.proc.returncode is None:
+            self.proc.kill()
+        await self.proc.wait()
+
+    async def read(self, rows, width):
+        """Read the next band of rows, padded with transparent pixels up to
+        (rows, width) where this image is smaller than the other one"""
+        band = np.zeros((rows, width, 4), dtype=np.uint8)
+        n = min(rows, self.height - self.rows_read)
+        if n > 0:
+            try:
+                data = await self.proc.stdout.readexactly(n * self.width * 4)
+            except asyncio.IncompleteReadError:
+                stderr = await self.proc.stderr.read()
+                raise CompareError(f"failed to stream {self.path}: {stderr.decode()}")
+            band[:n, : self.width] = np.frombuffer(data, dtype=np.uint8).reshape(n, self.width, 4)
+            self.rows_read += n
+        return band
+
+
+class PNGWriter(object):
+    """Minimal streaming PNG encoder. Rows are deflated and written out as they
+    arrive so the whole image never has to be held in memory."""
+
+    def __init__(self, path, width, height):
+        self.width = width
+        self.fp = open(path, "wb")
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        # 8-bit RGB, no interlacing
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(6)
+
+    def chunk(self, tag, data):
+        self.fp.write(struct.pack(">I", len(data)) + tag + data)
+        self.fp.write(struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    def write(self, rows):
+        """Write a (n, width, 3) uint8 array of rows"""
+        # every scanline starts with its filter type, 0 (none)
+        scanlines = np.zeros((len(rows), self.width * 3 + 1), dtype=np.uint8)
+        scanlines[:, 1:] = rows.reshape(len(rows), -1)
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self.chunk(b"IDAT", data)
+
+    def close(self):
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+        self.fp.close()
+
+
+def block_view(a):
+    """View the (rows, width) array a as (rows / BLOCK, width / BLOCK, BLOCK *
+    BLOCK) blocks, dropping partial blocks at the edges"""
+    rows, width = a.shape[0] // BLOCK * BLOCK, a.shape[1] // BLOCK * BLOCK
+    a = a[:rows, :width]
+    return (
+        a.reshape(rows // BLOCK, BLOCK, width // BLOCK, BLOCK)
+        .swapaxes(1, 2)
+        .reshape(rows // BLOCK, width // BLOCK, BLOCK * BLOCK)
+    )
+
+
+def block_ssim(x, y):
+    """SSIM of each pair of blocks in x and y, (n, BLOCK * BLOCK) arrays"""
+    mu_x, mu_y = x.mean(axis=-1), y.mean(axis=-1)
+    var_x, var_y = x.var(axis=-1), y.var(axis=-1)
+    cov = (x * y).mean(axis=-1) - mu_x * mu_y
+    return ((2 * mu_x * mu_y + C1) * (2 * cov + C2)) / (
+        (mu_x**2 + mu_y**2 + C1) * (var_x + var_y + C2)
+    )
+
+
+def label(mask):
+    """Label the 8-connected components of the 2D boolean mask. Every cell
+    repeatedly takes the smallest label among its neighbours, with pointer
+    jumping to collapse long chains, until nothing changes. Returns an array of
+    the same shape holding, for each True cell, the flat index of the first
+    cell of its component."""
+    none = mask.size
+    labels = np.where(mask, np.arange(mask.size).reshape(mask.shape), none)
+    while True:
+        padded = np.pad(labels, 1, constant_values=none)
+        rows, cols = mask.shape
+        smallest = labels
+        for dy in range(3):
+            for dx in range(3):
+                smallest = np.minimum(smallest, padded[dy : dy + rows, dx : dx + cols])
+        smallest = np.where(mask, smallest, none)
+        flat = np.append(smallest.ravel(), none)
+        smallest = flat[smallest]
+        if np.array_equal(smallest, labels):
+            return labels
+        labels = smallest
+
+
+class Regions(object):
+    """The bounding boxes of the connected regions of changed blocks, found a
+    band at a time. Each band is labelled on its own and joined to the regions
+    touching the last block row of the band above. Regions that don't touch it
+    can't grow any more, so they're finished and only the largest
+    MAX_DIFF_REGIONS are kept: memory depends on the width of the images but
+    not on their height."""
+
+    def __init__(self, cols):
+        # the open region of each block in the last block row seen, -1 for none
+        self.edge = np.full(cols, -1)
+        self.edge_row = -1
+        # open region -> [x0, y0, x1, y1]
+        self.open = {}
+        self.next_id = 0
+        # the largest finished regions, a heap of (size, sequence, box)
+        self.finished = []
+
+    def finish(self, box):
+        x0, y0, x1, y1 = box
+        item = ((x1 - x0 + 1) * (y1 - y0 + 1), -self.next_id, tuple(box))
+        self.next_id += 1
+        if len(self.finished) < MAX_DIFF_REGIONS:
+            heapq.heappush(self.finished, item)
+        elif MAX_DIFF_REGIONS > 0:
+            heapq.heappushpop(self.finished, item)
+
+    def finish_open(self):
+        for box in self.open.values():
+            self.finish(box)
+        self.open = {}
+        self.edge[:] = -1
+
+    def add(self, grid_top, grid, extents):
+        """Add the (rows, cols) grid of changed blocks of a band starting at
+        block row grid_top, with extents the (rows * cols, 4) pixel extents of
+        the changes in each block"""
+        if grid_top != self.edge_row + 1:
+            self.finish_open()
+        self.edge_row = grid_top + grid.shape[0] - 1
+        cells = np.flatnonzero(grid)
+        if not len(cells):
+            self.finish_open()
+            return
+        labels = label(grid)
+        components, index = np.unique(labels.ravel()[cells], return_inverse=True)
+        boxes = np.full((len(components), 4), -1)
+        boxes[:, :2] = np.iinfo(boxes.dtype).max
+        np.minimum.at(boxes[:, 0], index, extents[cells, 0])
+        np.minimum.at(boxes[:, 1], index, extents[cells, 1])
+        np.maximum.at(boxes[:, 2], index, extents[cells, 2])
+        np.maximum.at(boxes[:, 3], index, extents[cells, 3])
+
+        def component(row, col):
+            return int(np.searchsorted(components, labels[row, col]))
+
+        # union-find over the band's components (0..n-1) and the open regions
+        # (n + region), joined where the first row touches the edge above
+        n = len(components)
+        parent = {}
+
+        def find(x):
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for col in np.flatnonzero(grid[0]):
+            for above in self.edge[max(col - 1, 0) : col + 2]:
+                if above >= 0:
+                    a, b = find(component(0, col)), find(n + int(above))
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+
+        merged = {}
+        for i in range(n):
+            merged.setdefault(find(i), []).append(boxes[i])
+        for region, box in self.open.items():
+            merged.setdefault(find(n + region), []).append(np.array(box))
+
+        # regions reaching the band's last row stay open, the rest are finished
+        last = {find(component(-1, col)) for col in np.flatnonzero(grid[-1])}
+        self.open, ids = {}, {}
+        for root, members in merged.items():
+            members = np.array(members)
+            box = [*members[:, :2].min(axis=0), *members[:, 2:].max(axis=0)]
+            if root in last:
+                ids[root] = self.next_id
+                self.open[self.next_id] = box
+                self.next_id += 1
+            else:
+                self.finish(box)
+        self.edge[:] = -1
+        for col in np.flatnonzero(grid[-1]):
+            self.edge[col] = ids[find(component(-1, col))]
+
+    def boxes(self):
+        """The largest regions, largest first"""
+        self.finish_open()
+        return [box for _, _, box in sorted(self.finished, reverse=True)]
+
+
+def flatten(band):
+    """Composite RGBA pixels onto a white background, like convert -flatten"""
+    alpha = band[..., 3:] / 255
+    return band[..., :3] * alpha + 255 * (1 - alpha)
+
+
+def grayscale(rgb):
+    """Rec709Luminance of flattened sRGB pixels, re-encoded as sRGB"""
+    linear = LINEAR[np.rint(rgb).astype(np.uint8)] @ REC709
+    return np.searchsorted(LINEAR, linear).clip(0, 255).astype(np.uint8)
+
+
+class TiledComparison(object):
+    """Accumulates the comparison of two images one band of rows at a time:
+    MAE, block-wise SSIM, the share of changed pixels and the regions of
+    changed blocks.
+
+    Work is skipped at the coarsest level that shows the images agree: an
+    identical band needs no per-pixel metrics, and SSIM is only computed for
+    blocks that differ."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.top = 0
+        self.abs_error = 0
+        self.diff_pixels = 0
+        self.ssim_sum = 0.0
+        self.ssim_blocks = 0
+        self.changed_regions = Regions(-(-width // BLOCK))
+
+    def update(self, screenshot, frame, diff_images=True):
+        """Compare a band of RGBA rows from each image, returning the gray and
+        blue difference rows when diff_images is set"""
+        top, rows = self.top, len(screenshot)
+        self.top += rows
+        identical = np.array_equal(screenshot, frame)
+        screenshot_rgb = flatten(screenshot)
+        frame_rgb = flatten(frame)
+        gray_s, gray_f = grayscale(screenshot_rgb), grayscale(frame_rgb)
+        blocks_s = block_view(gray_s)
+        self.ssim_blocks += blocks_s.shape[0] * blocks_s.shape[1]
+        if identical:
+            self.ssim_sum += blocks_s.shape[0] * blocks_s.shape[1]
+        else:
+            self.update_metrics(top, screenshot_rgb, frame_rgb, gray_s, gray_f)
+
+        if not diff_images:
+            return None, None
+        # screenshot, frame and their darkest pixels in the R, G and B channels
+        gray = np.stack([gray_s, gray_f, np.minimum(gray_s, gray_f)], axis=-1)
+
+        # fade the screenshot and highlight every pixel that differs at all
+        blue = (screenshot_rgb * (1 - LOWLIGHT) + 255 * LOWLIGHT).astype(np.uint8)
+        if not identical:
+            blue[(screenshot != frame).any(axis=-1)] = HIGHLIGHT
+        return gray, blue
+
+    def update_metrics(self, top, screenshot_rgb, frame_rgb, gray_s, gray_f):
+        abs_diff = np.abs(screenshot_rgb - frame_rgb)
+        self.abs_error += abs_diff.sum()
+        changed = (abs_diff > DIFF_THRESHOLD).any(axis=-1)
+        self.diff_pixels += int(changed.sum())
+
+        # SSIM of the blocks that differ, identical blocks score 1
+        blocks_s, blocks_f = block_view(gray_s), block_view(gray_f)
+        differs = (blocks_s != blocks_f).any(axis=-1)
+        self.ssim_sum += (~differs).sum()
+        self.ssim_sum += block_ssim(
+            blocks_s[differs].astype(np.float64), blocks_f[differs].astype(np.float64)
+        ).sum()
+
+        # pad to whole blocks so partial blocks at the edges count as changed
+        rows, width = changed.shape
+        padded = np.zeros((-(-rows // BLOCK) * BLOCK, -(-width // BLOCK) * BLOCK), dtype=bool)
+        padded[:rows, :width] = changed
+        grid = block_view(padded).any(axis=-1)
+        if not grid.any():
+            return
+        # pixel extents of the changes within each changed block
+        ys, xs = np.nonzero(padded)
+        cells = (ys // BLOCK) * grid.shape[1] + xs // BLOCK
+        extents = np.full((grid.size, 4), -1)
+        extents[:, :2] = np.iinfo(extents.dtype).max
+        np.minimum.at(extents[:, 0], cells, xs)
+        np.minimum.at(extents[:, 1], cells, ys + top)
+        np.maximum.at(extents[:, 2], cells, xs)
+        np.maximum.at(extents[:, 3], cells, ys + top)
+        self.changed_regions.add(top // BLOCK, grid, extents)
+
+    def regions(self):
+        """Bounding boxes of the connected regions of changed blocks, largest
+        first"""
+        return [
+            {
+                "x": int(x0),
+                "y": int(y0),
+                "width": int(x1 - x0 + 1),
+                "height": int(y1 - y0 + 1),
+            }
+            for x0, y0, x1, y1 in self.changed_regions.boxes()
+        ]
+
+    @property
+    def mae(self):
+        return self.abs_error / (self.width * self.height * 3 * 255)
+
+    def results(self):
+        return {
+            "MAE": f"{self.mae * QUANTUM_RANGE:g} ({self.mae:g})",
+            "mae": float(self.mae),
+            "ssim": float(self.ssim_sum / self.ssim_blocks) if self.ssim_blocks else 1.0,
+            "diff_pixels_pct": 100 * self.diff_pixels / (self.width * self.height),
+            "diff_regions": self.regions(),
+        }
+
+
+def identical_results():
+    return {"MAE": "0 (0)", "mae": 0.0, "ssim": 1.0, "diff_pixels_pct": 0.0, "diff_regions": []}
+
+
+async def compare_images(
+    screenshot, frame, gray_difference=None, blue_difference=None, band_rows=BAND_ROWS
+):
+    """Compare screenshot and frame in a single pass with peak memory bounded by
+    band_rows, regardless of the size of the images. Writes the same gray and
+    blue difference images as the convert and compare pipeline when they are
+    given and returns numeric results, including MAE in the format of compare
+    -metric MAE."""
+    diff_images = gray_difference is not None and blue_difference is not None
+    if not diff_images and filecmp.cmp(screenshot, frame, shallow=False):
+        log.info("images are identical, skipping comparison")
+        return identical_results()
+
+    (sw, sh), (fw, fh) = await asyncio.gather(identify(screenshot), identify(frame))
+    # images of different sizes are compared over the larger of the two
+    width, height = max(sw, fw), max(sh, fh)
+    # bands are made of whole blocks
+    band_rows = -(-band_rows // BLOCK) * BLOCK
+    log.info(f"tiled comparison {width}x{height} in bands of {band_rows} rows")
+    comparison = TiledComparison(width, height)
+    writers = (
+        [PNGWriter(gray_difference, width, height), PNGWriter(blue_difference, width, height)]
+        if diff_images
+        else []
+    )
+    try:
+        async with BandReader(screenshot, sw, sh) as s, BandReader(frame, fw, fh) as f:
+            for top in range(0, height, band_rows):
+                rows = min(band_rows, height - top)
+                s_band, f_band = await asyncio.gather(s.read(rows, width), f.read(rows, width))
+                diffs = comparison.update(s_band, f_band, diff_images=diff_images)
+                for writer, rows in zip(writers, diffs):
+                    writer.write(rows)
+    finally:
+        for writer in writers:
+            writer.close()
+    return comparison.results()
@@ -1,10 +1,15 @@
+import hashlib
 import json
 import os
 import shutil
 import socket
+import sqlite3
+import tempfile
 import time
 from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
+from urllib.parse import unquote
 
 import boto3
 from engi_helpful_scripts.log import setup_logging
@@ -16,28 +21,40 @@ from engi_message_queue import (
     get_sqs_url,
 )
 
-sns_client = boto3.client("sns")
+log = setup_logging("engi-same-story-api")
 
+# the git steps of a check change the working directory of the whole process,
+# so relative paths from the environment are taken from where it started
+START_DIR = Path.cwd()
 
-log = setup_logging("engi-same-story-api")
 
-s3_client = boto3.client("s3")
+@lru_cache(maxsize=None)
+def get_topic_arn(env=None):
+    """A place to submit job requests, TOPIC_ARN or looked up on first use"""
+    return os.environ.get("TOPIC_ARN") or get_sns_arn(get_name(env))
+
 
-AWS_REGION = boto3.session.Session().region_name
+@lru_cache(maxsize=None)
+def get_bucket_name(env=None):
+    """The S3 bucket to store the input image and output screenshots and results"""
+    return os.environ.get("BUCKET_NAME") or get_name(env)
+
+
+@lru_cache(maxsize=None)
+def get_queue_url(env=None):
+    """A place for the backend server to dequeue job requests, QUEUE_URL or
+    looked up on first use"""
+    return os.environ.get("QUEUE_URL") or get_sqs_url(get_name(env))
 
 
 def setup_env(env=None):
-    """env is one of dev, staging, production"""
-    name = get_name(env)
-    sns_topic = get_sns_arn(name)
-    # a place to submit job requests
-    os.environ["TOPIC_ARN"] = sns_topic
+    """env is one of dev, staging, production. Whatever is already set in the
+    environment is kept and not looked up."""
+    os.environ["TOPIC_ARN"] = get_topic_arn(env)
     log.info(f"{os.environ['TOPIC_ARN']=}")
-    # the S3 bucket to store the input image and output screenshots and results
-    os.environ["BUCKET_NAME"] = name
+    os.environ["BUCKET_NAME"] = get_bucket_name(env)
     log.info(f"{os.environ['BUCKET_NAME']=}")
-    # a place for the backend server to dequeue job requests
-    os.environ["QUEUE_URL"] = get_sqs_url(name)
+    os.environ["QUEUE_URL"] = get_queue_url(env)
     log.info(f"{os.environ['QUEUE_URL']=}")
 
 
@@ -50,20 +67,332 @@ def cleanup_directory(path):
             shutil.rmtree(path)
 
 
+def get_free_memory():
+    """Bytes of memory available to this container (cgroup v2 or v1), or to the
+    host if it isn't limited"""
+    for limit, usage in [
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ]:
+        try:
+            limit, usage = Path(limit).read_text().strip(), Path(usage).read_text().strip()
+        except OSError:
+            continue
+        # v1 reports an enormous number when there's no limit
+        if limit != "max" and int(limit) < 2**60:
+            return int(limit) - int(usage)
+    with open("/proc/meminfo") as fp:
+        for line in fp:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
 def get_port():
     sock = socket.socket()
     sock.bind(("", 0))
     return sock.getsockname()[1]
 
 
-def get_s3_url(suffix):
-    return f"{s3_client.meta.endpoint_url}/{suffix}"
+@lru_cache(maxsize=None)
+def get_aws_client(name):
+    """AWS clients are created on first use, so nothing needs AWS credentials
+    or a region until it actually talks to AWS"""
+    return boto3.client(name)
+
+
+class S3Storage(object):
+    """Check inputs and reports in an S3 bucket"""
+
+    def __init__(self, bucket_name):
+        self.name = self.bucket_name = bucket_name
+
+    def __repr__(self):
+        return f"S3Storage({self.bucket_name!r})"
 
+    @property
+    def client(self):
+        return get_aws_client("s3")
 
-def make_s3_public(suffix):
-    bits = suffix.split("/")
-    bucket, key = bits[0], "/".join(bits[1:])
-    return boto3.resource("s3").ObjectAcl(bucket, key).put(ACL="public-read")
+    def put(self, key, body):
+        return self.client.put_object(Body=body, Bucket=self.bucket_name, Key=key)
+
+    def get(self, key):
+        r = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        return r["Body"].read()
+
+    def list(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
+
+    def exists(self, prefix):
+        r = self.client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix, MaxKeys=1)
+        return "Contents" in r
+
+    def delete(self, prefix):
+        for key in self.list(prefix):
+            self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def upload_file(self, local, key, public=False, content_type=None, content_encoding=None):
+        extra_args = {}
+        if public:
+            extra_args["ACL"] = "public-read"
+        if content_type:
+            extra_args["ContentType"] = content_type
+        if content_encoding:
+            extra_args["ContentEncoding"] = content_encoding
+        self.client.upload_file(str(local), self.bucket_name, str(key), ExtraArgs=extra_args)
+
+    def upload_dir(self, local_dir, prefix, public=False):
+        for path in Path(local_dir).rglob("*"):
+            if path.is_file():
+                key = f"{prefix}/{path.relative_to(local_dir).as_posix()}"
+                self.upload_file(path, key, public=public)
+
+    def download_file(self, key, local):
+        Path(local).parent.mkdir(parents=True, exist_ok=True)
+        self.client.download_file(self.bucket_name, key, str(local))
+
+    def download_dir(self, prefix, local_dir):
+        for key in self.list(f"{prefix}/"):
+            self.download_file(key, Path(local_dir) / key[len(prefix) + 1 :])
+
+    def make_public(self, key):
+        self.client.put_object_acl(Bucket=self.bucket_name, Key=key, ACL="public-read")
+
+    def get_url(self, key_quoted):
+        return f"{self.client.meta.endpoint_url}/{self.bucket_name}/{key_quoted}"
+
+
+class LocalStorage(object):
+    """Check inputs and reports in a local directory laid out like the S3
+    bucket, for running checks without AWS"""
+
+    name = "local"
+
+    def __init__(self, directory):
+        self.directory = Path(directory).resolve()
+
+    def __repr__(self):
+        return f"LocalStorage({str(self.directory)!r})"
+
+    def path(self, key):
+        return self.directory / key
+
+    def put(self, key, body):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(body.encode() if isinstance(body, str) else body)
+
+    def get(self, key):
+        return self.path(key).read_bytes()
+
+    def list(self, prefix):
+        # only walk the directory the prefix is in
+        top = self.path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.directory
+        for path in sorted(top.rglob("*")):
+            key = path.relative_to(self.directory).as_posix()
+            if path.is_file() and key.startswith(prefix):
+                yield key
+
+    def exists(self, prefix):
+        return next(self.list(prefix), None) is not None
+
+    def delete(self, prefix):
+        for key in list(self.list(prefix)):
+            self.path(key).unlink()
+
+    def upload_file(self, local, key, public=False, content_type=None, content_encoding=None):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(local, path)
+
+    def upload_dir(self, local_dir, prefix, public=False):
+        shutil.copytree(local_dir, self.path(prefix), dirs_exist_ok=True)
+
+    def download_file(self, key, local):
+        Path(local).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(self.path(key), local)
+
+    def download_dir(self, prefix, local_dir):
+        if self.path(prefix).is_dir():
+            shutil.copytree(self.path(prefix), local_dir, dirs_exist_ok=True)
+
+    def make_public(self, key):
+        pass
+
+    def get_url(self, key_quoted):
+        return self.path(unquote(key_quoted)).as_uri()
+
+
+class ResultsIndex(object):
+    """Check results in SQLite by repository, component, story and commit, so
+    that history and trends can be queried without listing storage. Each worker
+    keeps its own and syncs it to index/ in storage, Client merges them.
+    Checks are indexed by the commit they checked out (head_commit), which the
+    spec may only have given as a short SHA or not at all."""
+
+    METRICS = ["mae", "ssim", "diff_pixels_pct"]
+    # spec fields left out of the index, which is shared by everyone
+    SECRETS = ["github_token"]
+
+    def __init__(self, path=":memory:"):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                check_id TEXT PRIMARY KEY,
+                repository TEXT,
+                component TEXT,
+                story TEXT,
+                branch TEXT,
+                "commit" TEXT,
+                width INTEGER,
+                height INTEGER,
+                created_at REAL,
+                completed_at REAL,
+                error TEXT,
+                mae REAL,
+                ssim REAL,
+                diff_pixels_pct REAL,
+                results TEXT
+            );
+            CREATE INDEX IF NOT EXISTS results_story
+                ON results (repository, component, story, completed_at);
+            CREATE INDEX IF NOT EXISTS results_commit ON results (repository, "commit");
+            """
+        )
+
+    def add(self, results_d):
+        """Index the contents of a results.json, replacing any earlier results
+        of the same check"""
+        results_d = {key: value for key, value in results_d.items() if key not in self.SECRETS}
+        error = results_d.get("error")
+        row = {
+            "check_id": results_d["check_id"],
+            **{key: results_d.get(key) for key in ["repository", "component", "story", "branch"]},
+            # checks that failed before checking out only have the spec's commit
+            "commit": results_d.get("head_commit") or results_d.get("commit"),
+            "width": results_d.get("width"),
+            "height": results_d.get("height"),
+            "created_at": results_d.get("created_at"),
+            # errors are reported without timestamps
+            "completed_at": results_d.get("completed_at") or time.time(),
+            # the e_key
+            "error": next(iter(error)) if error else None,
+            **{key: results_d.get(key) for key in self.METRICS},
+            "results": json.dumps(results_d),
+        }
+        columns = ", ".join(f'"{key}"' for key in row)
+        values = ", ".join(f":{key}" for key in row)
+        with self.db:
+            self.db.execute(f"INSERT OR REPLACE INTO results ({columns}) VALUES ({values})", row)
+
+    def merge(self, path):
+        """Add the results in the index at path"""
+        with self.db:
+            self.db.execute("ATTACH DATABASE ? AS shard", (str(path),))
+        try:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO results SELECT * FROM shard.results")
+        finally:
+            self.db.execute("DETACH DATABASE shard")
+
+    def snapshot(self, path):
+        """Copy the index to path, consistently even while it's being written"""
+        target = sqlite3.connect(str(path))
+        try:
+            self.db.backup(target)
+        finally:
+            target.close()
+        return path
+
+    def history(self, repository, component=None, story=None, branch=None, commit=None, limit=100):
+        """Results of the checks of a repository, optionally only of a component,
+        story, branch or commit (or a prefix of it, like a short SHA), the
+        latest first"""
+        where = {
+            "repository": repository,
+            "component": component,
+            "story": story,
+            "branch": branch,
+        }
+        where = {key: value for key, value in where.items() if value is not None}
+        conditions = [f'"{key}" = :{key}' for key in where]
+        if commit is not None:
+            where["commit"] = commit
+            conditions.append('substr("commit", 1, length(:commit)) = :commit')
+        conditions = " AND ".join(conditions)
+        rows = self.db.execute(
+            f"SELECT results FROM results WHERE {conditions} "
+            "ORDER BY completed_at DESC LIMIT :limit",
+            {**where, "limit": limit},
+        )
+        return [json.loads(row["results"]) for row in rows]
+
+    def trend(self, repository, component, story, metric="mae"):
+        """How metric changed across commits for a story: (commit, completed_at,
+        value) of the latest successful check of each commit checked out, oldest
+        first. Checks without a commit count as their own."""
+        if metric not in self.METRICS:
+            raise ValueError(f"{metric=} isn't one of {self.METRICS}")
+        # SQLite takes the bare columns from the row with the MAX
+        rows = self.db.execute(
+            f'SELECT "commit", MAX(completed_at) AS completed_at, {metric} AS value '
+            "FROM results WHERE repository = ? AND component = ? AND story = ? "
+            f"AND error IS NULL AND {metric} IS NOT NULL "
+            'GROUP BY COALESCE("commit", check_id) ORDER BY completed_at',
+            (repository, component, story),
+        )
+        return [(row["commit"], row["completed_at"], row["value"]) for row in rows]
+
+
+def get_abs_path(path):
+    """path relative to START_DIR, whatever the current working directory"""
+    return START_DIR / path
+
+
+def gettempdir():
+    # return tempfile.gettempdir()
+    return get_abs_path(os.environ.get("TMPDIR", "/tmp/"))
+
+
+def get_storage():
+    """STORAGE is s3 (the default) or local, with checks kept in STORAGE_DIR"""
+    if os.environ.get("STORAGE", "s3") == "local":
+        return LocalStorage(get_abs_path(os.environ.get("STORAGE_DIR", "same-story-storage")))
+    return S3Storage(get_bucket_name())
+
+
+def get_story_key(spec_d):
+    """Checks of the same story supersede each other"""
+    return tuple(spec_d.get(key) for key in ("repository", "component", "story"))
+
+
+def get_cancel_key(check_id):
+    """Marks a check as cancelled for whichever worker has it"""
+    return f"checks/{check_id}/cancel"
+
+
+def get_latest_key(spec_d):
+    """Holds the check_id and SentTimestamp of the newest check of a story"""
+    story = hashlib.sha256(json.dumps(get_story_key(spec_d)).encode()).hexdigest()
+    return f"stories/{story}/latest.json"
+
+
+def get_latest(storage, spec_d):
+    key = get_latest_key(spec_d)
+    if not storage.exists(key):
+        return None
+    return json.loads(storage.get(key))
 
 
 class Client(object):
@@ -78,15 +407,19 @@ class Client(object):
         "commit",  # optional
     ]
 
-    def __init__(self):
-        self.bucket_name = os.environ["BUCKET_NAME"]
-        self.topic_arn = os.environ["TOPIC_ARN"]
+    def __init__(self, storage=None):
+        self.storage = storage or get_storage()
+        self.index = None
+
+    @property
+    def topic_arn(self):
+        return get_topic_arn()
 
     def upload(self, key_name, body):
-        return s3_client.put_object(Body=body, Bucket=self.bucket_name, Key=key_name)
+        return self.storage.put(key_name, body)
 
     def upload_file(self, local, remote):
-        s3_client.upload_file(local, self.bucket_name, str(remote))
+        self.storage.upload_file(local, remote)
 
     def upload_frame(self, path):
         story = self.spec_d["story"]
@@ -100,17 +433,42 @@ class Client(object):
         return f"{self.prefix}/report/{suffix}.json"
 
     def download(self, key_name):
-        r = s3_client.get_object(Bucket=self.bucket_name, Key=key_name)
-        return r["Body"].read()
+        return self.storage.get(key_name)
 
     def delete(self, key_name):
-        r = s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=key_name)
-        for obj in r["Contents"]:
-            s3_client.delete_object(Bucket=self.bucket_name, Key=obj["Key"])
+        self.storage.delete(key_name)
 
     def exists(self, key_name):
-        r = s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=key_name)
-        return "Contents" in r
+        return self.storage.exists(key_name)
+
+    def get_index(self, refresh=False):
+        """The result indexes of all the workers, merged. They're downloaded
+        the first time, refresh to get the latest."""
+        if refresh or self.index is None:
+            self.index = ResultsIndex()
+            with tempfile.TemporaryDirectory() as tmp:
+                for key in self.storage.list("index/"):
+                    local = Path(tmp) / Path(key).name
+                    self.storage.download_file(key, local)
+                    self.index.merge(local)
+        return self.index
+
+    def get_history(self, repository, component=None, story=None, refresh=False, **kwargs):
+        """Results of earlier checks, see ResultsIndex.history"""
+        return self.get_index(refresh).history(repository, component, story, **kwargs)
+
+    def get_trend(self, repository, component, story, metric="mae", refresh=False):
+        """A metric of a story across commits, see ResultsIndex.trend"""
+        return self.get_index(refresh).trend(repository, component, story, metric)
+
+    def cancel(self, check_id):
+        """Cancel a queued or running check, on whichever worker has it or
+        receives it later"""
+        self.storage.put(get_cancel_key(check_id), json.dumps({"cancelled_at": time.time()}))
+        get_aws_client("sns").publish(
+            TopicArn=self.topic_arn,
+            Message=json.dumps({"action": "cancel", "check_id": check_id}),
+        )
 
     def get_results(self, spec_d, path, upload=True, callback=None, no_status=False, wait=2):
         self.spec_d = spec_d
@@ -133,7 +491,7 @@ class Client(object):
                 self.upload_frame(path)
 
             # publish the job
-            sns_client.publish(
+            get_aws_client("sns").publish(
                 TopicArn=self.topic_arn,
                 Message=json.dumps(spec_d),
             )
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import math
+import os
+import sys
+from time import time
+
+from helpful_scripts import get_abs_path, gettempdir, log
+
+# how often in seconds to publish the load metrics
+METRICS_SECS = int(os.environ.get("METRICS_SECS", 60))
+# where to publish them, any of emf (CloudWatch embedded metric format log lines
+# on stdout) and file (METRICS_FILE, rewritten every time), "" for nowhere
+METRICS_SINK = os.environ.get("METRICS_SINK", "emf")
+METRICS_FILE = str(
+    get_abs_path(os.environ.get("METRICS_FILE", gettempdir() / "same-story-metrics.json"))
+)
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SameStory")
+METRICS_SERVICE = os.environ.get("METRICS_SERVICE", "same-story-api")
+# adapt the receive batch size, long-poll wait and prefetch depth to how long
+# recent checks took, 0 to keep them fixed
+ADAPTIVE_POLLING = os.environ.get("ADAPTIVE_POLLING", "1") == "1"
+# how much weight the latest check gets in the moving averages of durations
+DURATION_ALPHA = float(os.environ.get("DURATION_ALPHA", 0.3))
+# don't receive more checks than can be started within this many seconds, the
+# rest are left in SQS for other workers
+TARGET_START_SECS = int(os.environ.get("TARGET_START_SECS", 120))
+# SQS limit on WaitTimeSeconds
+MAX_WAIT_TIME = 20
+
+
+class Ewma(object):
+    """Exponentially weighted moving average"""
+
+    def __init__(self, alpha=DURATION_ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        self.value = x if self.value is None else self.alpha * x + (1 - self.alpha) * self.value
+
+
+class Load(object):
+    """How busy the worker is, from the durations of its checks and the
+    backlog of its job queues. Publishes metrics to scale the service on and
+    sets how many messages to receive at a time, how long to wait for them and
+    how far ahead to prefetch."""
+
+    def __init__(self, max_batch, wait_time, prefetch_depth, max_prefetch_depth):
+        self.max_batch = max_batch
+        self.default_wait_time = wait_time
+        self.default_prefetch_depth = prefetch_depth
+        self.max_prefetch_depth = max_prefetch_depth
+        self.prepare = Ewma()
+        self.capture = Ewma()
+        self.capturing_since = None
+        self.busy_secs = 0.0
+        self.sampled_at = time()
+
+    def record(self, stage, secs):
+        getattr(self, stage).update(secs)
+
+    def start_capture(self):
+        self.capturing_since = time()
+
+    def end_capture(self):
+        now = time()
+        self.busy_secs += now - max(self.capturing_since, self.sampled_at)
+        self.capturing_since = None
+
+    def busy_fraction(self):
+        """The fraction of the time since the last call spent capturing"""
+        now = time()
+        busy = self.busy_secs
+        if self.capturing_since is not None:
+            busy += now - max(self.capturing_since, self.sampled_at)
+        fraction = busy / max(now - self.sampled_at, 1e-9)
+        self.busy_secs, self.sampled_at = 0.0, now
+        return min(fraction, 1.0)
+
+    def batch_size(self):
+        if not ADAPTIVE_POLLING or self.capture.value is None:
+            return self.max_batch
+        n = math.floor(TARGET_START_SECS / max(self.capture.value, 1))
+        return max(1, min(n, self.max_batch))
+
+    def wait_time(self):
+        """A long poll can't receive more than there was room for when it
+        started, so don't wait much longer than it takes a check to finish"""
+        if not ADAPTIVE_POLLING or self.capture.value is None:
+            return self.default_wait_time
+        return max(1, min(round(self.capture.value), MAX_WAIT_TIME))
+
+    def prefetch_depth(self):
+        """Enough checks prepared ahead to keep capturing while preparing
+        takes longer than capturing"""
+        if (
+            not ADAPTIVE_POLLING
+            or self.default_prefetch_depth == 0
+            or self.prepare.value is None
+            or self.capture.value is None
+        ):
+            return self.default_prefetch_depth
+        depth = math.ceil(self.prepare.value / max(self.capture.value, 1))
+        return max(1, min(depth, self.max_prefetch_depth))
+
+    async def get_backlog(self, job_queues):
+        """Messages waiting in and received from the job queues, by everyone"""
+        visible = not_visible = 0
+        for job_queue in job_queues:
+            r = await job_queue.sqs.get_queue_attributes(
+                QueueUrl=job_queue.url,
+                AttributeNames=[
+                    "ApproximateNumberOfMessages",
+                    "ApproximateNumberOfMessagesNotVisible",
+                ],
+            )
+            visible += int(r["Attributes"]["ApproximateNumberOfMessages"])
+            not_visible += int(r["Attributes"]["ApproximateNumberOfMessagesNotVisible"])
+        return visible, not_visible
+
+    async def get_metrics(self, job_queues):
+        in_flight = sum(q.in_flight for q in job_queues)
+        visible, not_visible = await self.get_backlog(job_queues)
+        # every worker holds about as many messages as this one does
+        workers = max(1, math.ceil(not_visible / max(in_flight, 1)))
+        backlog_per_worker = visible / workers
+        check_secs = self.capture.value or 0.0
+        return {
+            "Backlog": visible,
+            "BacklogNotVisible": not_visible,
+            "InFlight": in_flight,
+            "Workers": workers,
+            "BacklogPerWorker": backlog_per_worker,
+            # how long this worker would take to get through its share
+            "BacklogSeconds": backlog_per_worker * check_secs,
+            "BusyFraction": self.busy_fraction(),
+            "CheckSeconds": check_secs,
+            "PrepareSeconds": self.prepare.value or 0.0,
+            "ReceiveBatch": self.batch_size(),
+            "WaitTime": self.wait_time(),
+            "PrefetchDepth": self.prefetch_depth(),
+        }
+
+    def publish(self, metrics):
+        sinks = {sink.strip() for sink in METRICS_SINK.split(",")}
+        if "emf" in sinks:
+            emf = {
+                "_aws": {
+                    "Timestamp": int(time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [["Service"]],
+                            "Metrics": [{"Name": name} for name in metrics],
+                        }
+                    ],
+                },
+                "Service": METRICS_SERVICE,
+                **metrics,
+            }
+            # a log line of its own, CloudWatch Logs turns it into metrics
+            print(json.dumps(emf), file=sys.stdout, flush=True)
+        if "file" in sinks:
+            tmp = f"{METRICS_FILE}.tmp"
+            with open(tmp, "w") as fp:
+                json.dump({"timestamp": time(), **metrics}, fp)
+            os.replace(tmp, METRICS_FILE)
+
+    async def run(self, job_queues):
+        while True:
+            await asyncio.sleep(METRICS_SECS)
+            try:
+                self.publish(await self.get_metrics(job_queues))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(e)
@@ -0,0 +1,110 @@
+import asyncio
+import gzip
+import os
+import signal
+from collections import namedtuple
+
+from helpful_scripts import log
+from tracing import span
+
+# how much of the start and the end of each output stream to keep in memory and
+# report, the full output is spilled to a compressed log file
+OUTPUT_HEAD_BYTES = int(os.environ.get("OUTPUT_HEAD_BYTES", 4096))
+OUTPUT_TAIL_BYTES = int(os.environ.get("OUTPUT_TAIL_BYTES", 16384))
+READ_BYTES = 2**16
+
+# log_path is the compressed full output, stdout and stderr as they arrived
+CmdExit = namedtuple("CmdExit", ["cmd", "returncode", "stdout", "stderr", "log_path"])
+
+
+class OutputBuffer(object):
+    """Keeps the first head and the last tail bytes written to it, counting the
+    bytes dropped in between"""
+
+    def __init__(self, head=OUTPUT_HEAD_BYTES, tail=OUTPUT_TAIL_BYTES):
+        self.head_size = head
+        self.tail_size = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.omitted = 0
+
+    def write(self, data):
+        room = self.head_size - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        excess = len(self.tail) - self.tail_size
+        if excess > 0:
+            del self.tail[:excess]
+            self.omitted += excess
+
+    def getvalue(self):
+        omitted = f"\n... {self.omitted} bytes omitted ...\n".encode() if self.omitted else b""
+        return (bytes(self.head) + omitted + bytes(self.tail)).decode(errors="replace")
+
+
+def truncate(text):
+    """Bound text that wasn't captured through an OutputBuffer"""
+    if text is None:
+        return None
+    buffer = OutputBuffer()
+    buffer.write(text.encode())
+    return buffer.getvalue()
+
+
+class Processes(object):
+    """Runs the shell commands of one check. Each command is started in its own
+    session so the whole process tree under it (npm, storybook, chromium...)
+    can be killed when the check is cancelled. Only the head and tail of the
+    output are kept in memory, the full output is spilled to log_dir."""
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.running = set()
+        self.killed = False
+        self.count = 0
+
+    async def run(self, cmd, log_cmd=None, cwd=None):
+        log.info(f"running {log_cmd or cmd}")
+        if self.killed:
+            return CmdExit(cmd, -signal.SIGKILL, "", "killed before it started", None)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.count += 1
+        log_path = self.log_dir / f"{self.count:03d}.log.gz"
+        with span("subprocess", cmd=log_cmd or cmd, log_path=str(log_path)) as s:
+            proc = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+                cwd=cwd,
+            )
+            self.running.add(proc)
+            stdout, stderr = OutputBuffer(), OutputBuffer()
+            try:
+                with gzip.open(log_path, "wb") as spill:
+                    spill.write(f"$ {log_cmd or cmd}\n".encode())
+
+                    async def pump(stream, buffer):
+                        while chunk := await stream.read(READ_BYTES):
+                            buffer.write(chunk)
+                            spill.write(chunk)
+
+                    await asyncio.gather(pump(proc.stdout, stdout), pump(proc.stderr, stderr))
+                    await proc.wait()
+            finally:
+                self.running.discard(proc)
+            if s is not None:
+                s.set(pid=proc.pid, returncode=proc.returncode)
+        return CmdExit(cmd, proc.returncode, stdout.getvalue(), stderr.getvalue(), log_path)
+
+    def kill(self):
+        """Kill every running process group and refuse to start new ones"""
+        self.killed = True
+        for proc in self.running:
+            log.info(f"killing process group {proc.pid}")
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
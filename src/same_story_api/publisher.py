@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+from time import time
+
+from engi_message_queue import SNSFanoutSQS, get_name
+from helpful_scripts import log
+from tracing import CLIENT, current, record
+
+# visibility timeout for status messages
+STATUS_VISIBILITY_TIMEOUT = int(os.environ.get("STATUS_VISIBILITY_TIMEOUT", 5))
+# how many times to try publishing a status update and the first delay between
+# tries in seconds, doubled after every try
+STATUS_PUBLISH_TRIES = int(os.environ.get("STATUS_PUBLISH_TRIES", 5))
+STATUS_PUBLISH_BACKOFF = float(os.environ.get("STATUS_PUBLISH_BACKOFF", 0.5))
+# SNS limits on PublishBatch
+BATCH_ENTRIES = 10
+BATCH_BYTES = 256 * 1024
+# error codes meaning the endpoint doesn't support PublishBatch at all, rather
+# than that this attempt failed, e.g. throttling
+NO_BATCH_ERRORS = {"InvalidAction", "UnknownOperation", "UnknownOperationException"}
+# error codes meaning the topic can't be published to at all, e.g. the fanout of
+# the check was deleted, so its later updates are dropped without trying
+DEAD_TOPIC_ERRORS = {"NotFound", "AuthorizationError"}
+# error codes that trying again won't fix
+NO_RETRY_ERRORS = NO_BATCH_ERRORS | DEAD_TOPIC_ERRORS | {"InvalidParameter"}
+
+
+def get_sns_topic(spec_d):
+    """Get the SNS topic for status updates. If an ARN is given in spec_d then
+    use it. Otherwise, create a temporary SQS -> SNS fanout. It will get cleaned
+    up by a separate process."""
+    topic_arn = spec_d.get("sns_topic_arn")
+    if topic_arn is not None:
+        return topic_arn
+    check_id = spec_d["check_id"]
+    name = f"{get_name()}-{check_id}-status"
+    fanout = SNSFanoutSQS(name, persist=True, visibility_timeout=STATUS_VISIBILITY_TIMEOUT).create()
+    return fanout.topic_arn
+
+
+def get_entry(msg, body, topic_arn):
+    entry = {"Message": body}
+    if topic_arn.endswith("fifo"):
+        # FIFO (first-in-first-out) topics require additional params for deduplication
+        entry.update(
+            {"MessageGroupId": msg["check_id"], "MessageDeduplicationId": str(msg["step"])}
+        )
+    return entry
+
+
+def get_error_code(e):
+    """The error code of a botocore ClientError, None for anything else"""
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+def get_batches(entries):
+    """Split entries into batches within the SNS PublishBatch limits"""
+    batch, size = [], 0
+    for entry in entries:
+        entry_size = len(entry["Message"].encode())
+        if batch and (len(batch) == BATCH_ENTRIES or size + entry_size > BATCH_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append(entry)
+        size += entry_size
+    if batch:
+        yield batch
+
+
+class StatusPublisher(object):
+    """Publishes the status updates of a worker's checks in the background, so
+    a check never waits on an SNS round trip. Updates are queued in order and
+    whatever has queued up by the time SNS is free goes out together with
+    publish_batch, falling back to publish where it isn't supported. Each topic
+    gets its updates in order, with failures retried with backoff before moving
+    on, while the topics are published to concurrently, so a topic that keeps
+    failing doesn't hold up the others. Errors that won't go away aren't
+    retried, and a topic that is gone is skipped until its check ends."""
+
+    def __init__(self, sns):
+        self.sns = sns
+        self.queue = asyncio.Queue()
+        self.topics = {}
+        self.no_batch = set()
+        self.dead_topics = set()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def publish(self, spec_d, msg):
+        """The status callback of a CheckRequest"""
+        # serialize now, the results in msg keep changing as the check runs, and
+        # remember the span of the check that sent it
+        self.queue.put_nowait((spec_d, msg, json.dumps(msg), current()))
+
+    async def get_topic(self, spec_d):
+        check_id = spec_d["check_id"]
+        if check_id not in self.topics:
+            try:
+                # creating a fanout makes blocking AWS calls
+                self.topics[check_id] = await asyncio.to_thread(get_sns_topic, spec_d)
+            except Exception as e:
+                log.exception(e)
+                return None
+        return self.topics[check_id]
+
+    async def run(self):
+        while True:
+            updates = [await self.queue.get()]
+            while not self.queue.empty():
+                updates.append(self.queue.get_nowait())
+            try:
+                await self.publish_updates(updates)
+            except Exception as e:
+                log.exception(e)
+            for _ in updates:
+                self.queue.task_done()
+
+    async def publish_updates(self, updates):
+        topics = [await self.get_topic(spec_d) for spec_d, _, _, _ in updates]
+        # the updates to each topic go out together, in order
+        groups = {}
+        for topic_arn, update in zip(topics, updates):
+            if topic_arn is not None and topic_arn not in self.dead_topics:
+                groups.setdefault(topic_arn, []).append(update)
+        await asyncio.gather(*[self.publish_group(t, group) for t, group in groups.items()])
+        for _, msg, _, _ in updates:
+            if "error" in msg or msg["step"] == msg["step_count"] - 1:
+                # that was the last update of the check
+                self.dead_topics.discard(self.topics.pop(msg["check_id"], None))
+
+    async def publish_group(self, topic_arn, group):
+        entries = [get_entry(msg, body, topic_arn) for _, msg, body, _ in group]
+        log.info(f"sending {len(entries)} status updates to {topic_arn=}")
+        started_at = time()
+        try:
+            for batch in get_batches(entries):
+                await self.publish_batch(topic_arn, batch)
+        except Exception as e:
+            if get_error_code(e) in DEAD_TOPIC_ERRORS:
+                self.dead_topics.add(topic_arn)
+            log.error(f"dropped {len(entries)} status updates to {topic_arn=}")
+            log.exception(e)
+            return
+        for _, msg, _, parent in group:
+            record(parent, "sns.publish", started_at, time(), CLIENT, step=msg["step"])
+
+    async def publish_batch(self, topic_arn, entries):
+        if topic_arn not in self.no_batch:
+            try:
+                await self.retry(self.send_batch, topic_arn, entries)
+                return
+            except Exception as e:
+                if get_error_code(e) not in NO_BATCH_ERRORS:
+                    raise
+                log.info(f"publish_batch unsupported, falling back to publish {topic_arn=} {e=}")
+                self.no_batch.add(topic_arn)
+        for entry in entries:
+            await self.retry(self.sns.publish, TopicArn=topic_arn, **entry)
+
+    async def send_batch(self, topic_arn, entries):
+        """Publish entries, raising unless they all succeed. Retries resend
+        everything from the first entry that failed, so the last copy of each
+        update goes out after those before it; FIFO topics drop the duplicates
+        by MessageDeduplicationId."""
+        r = await self.sns.publish_batch(
+            TopicArn=topic_arn,
+            PublishBatchRequestEntries=[{"Id": str(i), **e} for i, e in enumerate(entries)],
+        )
+        failed = r.get("Failed", [])
+        if failed:
+            entries[:] = entries[min(int(f["Id"]) for f in failed) :]
+            raise Exception(f"failed to publish {len(failed)} status updates {failed=}")
+
+    async def retry(self, func, *args, **kwargs):
+        delay = STATUS_PUBLISH_BACKOFF
+        for tries in range(1, STATUS_PUBLISH_TRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if tries == STATUS_PUBLISH_TRIES or get_error_code(e) in NO_RETRY_ERRORS:
+                    raise
+                log.info(f"retrying status update in {delay} seconds {e=}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def close(self, timeout):
+        """Wait up to timeout seconds for the queued updates to go out"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.error(f"gave up on {self.queue.qsize()} status updates after {timeout} seconds")
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
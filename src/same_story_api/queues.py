@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+from collections import deque
+from statistics import quantiles
+from time import time
+
+from helpful_scripts import get_queue_url, log
+from tracing import CLIENT, span
+
+# how many of the most recent waits per queue to keep for the wait time metrics
+QUEUE_STATS_WINDOW = int(os.environ.get("QUEUE_STATS_WINDOW", 200))
+# every VISIBILITY_HEARTBEAT_SECS the messages of the jobs received and not yet
+# done are hidden from other workers for another VISIBILITY_TIMEOUT seconds.
+# The queue's own visibility timeout must be longer than the heartbeat.
+VISIBILITY_TIMEOUT = int(os.environ.get("VISIBILITY_TIMEOUT", 300))
+VISIBILITY_HEARTBEAT_SECS = int(os.environ.get("VISIBILITY_HEARTBEAT_SECS", 60))
+
+
+def get_queue_configs(default_max_in_flight):
+    """The job queues to poll. QUEUES is a JSON list like
+
+        [{"name": "interactive", "url": "https://...", "weight": 4, "max_in_flight": 2},
+         {"name": "bulk", "url": "https://...", "weight": 1, "max_in_flight": 1}]
+
+    Without it there's just QUEUE_URL, looked up if it isn't set."""
+    queues = os.environ.get("QUEUES")
+    configs = json.loads(queues) if queues else [{"name": "default", "url": get_queue_url()}]
+    for config in configs:
+        config.setdefault("name", config["url"].rsplit("/", 1)[-1])
+        config.setdefault("weight", 1)
+        config.setdefault("max_in_flight", default_max_in_flight)
+    return configs
+
+
+class QueueStats(object):
+    """How long checks from one queue waited before being started, from when
+    they were sent to SQS (wait) and from when this worker received them
+    (local_wait)"""
+
+    def __init__(self):
+        self.received = 0
+        self.started = 0
+        self.waits = deque(maxlen=QUEUE_STATS_WINDOW)
+        self.local_waits = deque(maxlen=QUEUE_STATS_WINDOW)
+
+    def start(self, job):
+        now = time()
+        self.started += 1
+        self.waits.append(now - job.sent_at)
+        self.local_waits.append(now - job.received_at)
+
+    @staticmethod
+    def percentiles(waits):
+        if not waits:
+            return {"p50": None, "p95": None, "max": None}
+        if len(waits) == 1:
+            p50 = p95 = waits[0]
+        else:
+            cuts = quantiles(waits, n=20, method="inclusive")
+            p50, p95 = cuts[9], cuts[18]
+        return {"p50": round(p50, 3), "p95": round(p95, 3), "max": round(max(waits), 3)}
+
+    def summary(self):
+        return {
+            "received": self.received,
+            "started": self.started,
+            "wait": self.percentiles(self.waits),
+            "local_wait": self.percentiles(self.local_waits),
+        }
+
+
+class Job(object):
+    """A check received from one of the job queues"""
+
+    def __init__(self, job_queue, check, receipt_handle, sent_at):
+        self.job_queue = job_queue
+        self.check = check
+        self.receipt_handle = receipt_handle
+        self.sent_at = sent_at
+        self.received_at = time()
+
+    async def done(self):
+        await self.job_queue.done(self)
+
+
+class JobQueue(object):
+    """An SQS job queue. Its poller only receives messages while fewer than
+    max_in_flight of its checks are waiting or running on this worker, so a
+    burst on one queue can't crowd out the others."""
+
+    def __init__(self, sqs, url, name, weight=1, max_in_flight=1):
+        self.sqs = sqs
+        self.url = url
+        self.name = name
+        self.weight = weight
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        # received jobs that aren't done, their messages kept invisible
+        self.jobs = set()
+        self.room = asyncio.Condition()
+        # received checks waiting to be started, and the virtual time the
+        # scheduler uses to share the worker between the queues by weight
+        self.pending = deque()
+        self.virtual_time = 0.0
+        self.stats = QueueStats()
+        # set once the first receive_message is on its way
+        self.polling = asyncio.Event()
+
+    def __repr__(self):
+        return f"JobQueue({self.name!r})"
+
+    async def poll(self, handle_message, scheduler, load):
+        """Receive messages forever, handing them to handle_message, which
+        returns a Job or None if the message wasn't a check. load sets how many
+        messages to receive at a time and how long to wait for them."""
+        while True:
+            async with self.room:
+                await self.room.wait_for(lambda: self.in_flight < self.max_in_flight)
+                count = min(load.batch_size(), self.max_in_flight - self.in_flight, 10)
+            wait_time = load.wait_time()
+            try:
+                log.info(f"receiving messages from {self.name}")
+                self.polling.set()
+                r = await self.sqs.receive_message(
+                    QueueUrl=self.url,
+                    WaitTimeSeconds=wait_time,
+                    MaxNumberOfMessages=count,
+                    AttributeNames=["SentTimestamp"],
+                )
+                for m in r.get("Messages", []):
+                    job = await handle_message(self, m)
+                    if job is not None:
+                        self.jobs.add(job)
+                        self.in_flight += 1
+                        self.stats.received += 1
+                        scheduler.put(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(e)
+                await asyncio.sleep(wait_time)
+
+    async def delete(self, receipt_handle):
+        with span("sqs.delete_message", CLIENT, queue=self.name):
+            r = await self.sqs.delete_message(QueueUrl=self.url, ReceiptHandle=receipt_handle)
+        log.info(f"deleting from {self.name} {receipt_handle=} {r=}")
+
+    async def change_visibility(self, jobs, timeout):
+        # at most 10 entries per request
+        jobs = list(jobs)
+        for i in range(0, len(jobs), 10):
+            entries = [
+                {"Id": str(n), "ReceiptHandle": job.receipt_handle, "VisibilityTimeout": timeout}
+                for n, job in enumerate(jobs[i : i + 10])
+            ]
+            r = await self.sqs.change_message_visibility_batch(QueueUrl=self.url, Entries=entries)
+            if r.get("Failed"):
+                log.error(f"failed to change visibility on {self.name} {r['Failed']=}")
+
+    async def heartbeat(self):
+        """Keep the messages of the jobs waiting or running on this worker from
+        being delivered to another one"""
+        while True:
+            await asyncio.sleep(VISIBILITY_HEARTBEAT_SECS)
+            try:
+                await self.change_visibility(self.jobs, VISIBILITY_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(e)
+
+    async def release(self):
+        """Make the messages of the jobs that aren't done visible again, for
+        another worker to take when this one shuts down"""
+        if self.jobs:
+            log.info(f"releasing {len(self.jobs)} jobs to {self.name}")
+            await self.change_visibility(self.jobs, 0)
+
+    async def done(self, job):
+        """Remove the message of a completed job and make room for another"""
+        self.jobs.discard(job)
+        try:
+            await self.delete(job.receipt_handle)
+        finally:
+            async with self.room:
+                self.in_flight -= 1
+                self.room.notify_all()
+
+
+class FairScheduler(object):
+    """Hands out received jobs in weighted fair order (start-time fair
+    queueing). Each queue's virtual time advances by 1 / weight for every job
+    started from it and the backlogged queue furthest behind goes next, so a
+    queue with weight 4 starts 4 jobs for every one from a queue with weight 1.
+    A queue that was idle rejoins at the current virtual time rather than
+    catching up on the turns it missed."""
+
+    def __init__(self, job_queues):
+        self.job_queues = job_queues
+        self.virtual_time = 0.0
+        self.ready = asyncio.Event()
+
+    def put(self, job):
+        job_queue = job.job_queue
+        if not job_queue.pending:
+            job_queue.virtual_time = max(job_queue.virtual_time, self.virtual_time)
+        job_queue.pending.append(job)
+        self.ready.set()
+
+    async def get(self):
+        while True:
+            backlogged = [q for q in self.job_queues if q.pending]
+            if backlogged:
+                break
+            self.ready.clear()
+            await self.ready.wait()
+        job_queue = min(backlogged, key=lambda q: q.virtual_time)
+        self.virtual_time = job_queue.virtual_time
+        job_queue.virtual_time += 1 / job_queue.weight
+        job = job_queue.pending.popleft()
+        job_queue.stats.start(job)
+        return job
+
+    def summary(self):
+        return {
+            q.name: {"pending": len(q.pending), "in_flight": q.in_flight, **q.stats.summary()}
+            for q in self.job_queues
+        }
@@ -0,0 +1,146 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import tarfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from helpful_scripts import log
+
+# how many static Storybook builds to keep in the local cache
+STATIC_BUILD_CACHE_SIZE = int(os.environ.get("STATIC_BUILD_CACHE_SIZE", 20))
+
+LOCKFILES = ["package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml"]
+
+
+def get_build_key(repository, commit, code):
+    """What a static build depends on: the repository, the commit and the
+    installed packages. None without a lockfile, there's no telling what npm
+    install would install."""
+    packages = hashlib.sha256()
+    locked = False
+    for name in ["package.json", *LOCKFILES]:
+        path = code / name
+        if path.exists():
+            packages.update(name.encode())
+            packages.update(path.read_bytes())
+            locked = locked or name in LOCKFILES
+    if not locked:
+        return None
+    return hashlib.sha256(f"{repository}\n{commit}\n{packages.hexdigest()}".encode()).hexdigest()
+
+
+def get_storycap_version(code):
+    """The version of storycap the repository's lockfile pins, or the range in
+    its package.json, for running storycap without npm install. None if it
+    has neither."""
+    path = code / "package-lock.json"
+    if not path.exists():
+        path = code / "npm-shrinkwrap.json"
+    if path.exists():
+        lock = json.loads(path.read_text())
+        # lockfileVersion 2 and 3, then 1
+        package = lock.get("packages", {}).get("node_modules/storycap")
+        package = package or lock.get("dependencies", {}).get("storycap")
+        if package and "version" in package:
+            return package["version"]
+    path = code / "yarn.lock"
+    if path.exists():
+        # the "storycap@^3.1.0": entry and its version "3.1.9" (yarn 1) or
+        # version: 3.1.9 (berry)
+        m = re.search(
+            r'^"?storycap@[^\n]*:\n(?:[ \t]+[^\n]*\n)*?[ \t]+version:? "?([^"\s]+)',
+            path.read_text(),
+            re.MULTILINE,
+        )
+        if m:
+            return m.group(1)
+    path = code / "pnpm-lock.yaml"
+    if path.exists():
+        # /storycap/3.1.9: (pnpm 6-8) or storycap@3.1.9: (pnpm 9)
+        m = re.search(r"^\s+'?/?storycap[/@](\d[^:(']*)", path.read_text(), re.MULTILINE)
+        if m:
+            return m.group(1)
+    path = code / "package.json"
+    if path.exists():
+        package = json.loads(path.read_text())
+        for key in "devDependencies", "dependencies":
+            version = package.get(key, {}).get("storycap")
+            if version:
+                return version
+    return None
+
+
+class BuildCache(object):
+    """Static Storybook builds by build key, as .tar.gz files in a local
+    directory and under storybook-builds/ in storage, shared by the workers"""
+
+    def __init__(self, storage, directory):
+        self.storage = storage
+        self.directory = directory
+
+    def path(self, key):
+        return self.directory / f"{key}.tar.gz"
+
+    def storage_key(self, key):
+        return f"storybook-builds/{key}.tar.gz"
+
+    def fetch(self, key, build_dir):
+        """Extract the build to build_dir, returning whether it was cached"""
+        path = self.path(key)
+        if not path.exists():
+            if not self.storage.exists(self.storage_key(key)):
+                return False
+            self.storage.download_file(self.storage_key(key), path)
+        # recently used, so evicted last
+        os.utime(path)
+        with tarfile.open(path) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(build_dir, filter="data")
+            else:
+                tar.extractall(build_dir)
+        return True
+
+    def put(self, key, build_dir):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp = path.with_name(f"{path.name}.tmp")
+        with tarfile.open(tmp, "w:gz") as tar:
+            tar.add(build_dir, arcname=".")
+        os.replace(tmp, path)
+        self.storage.upload_file(path, self.storage_key(key))
+        self.evict()
+
+    def evict(self):
+        builds = sorted(
+            self.directory.glob("*.tar.gz"), key=lambda path: path.stat().st_mtime, reverse=True
+        )
+        for path in builds[STATIC_BUILD_CACHE_SIZE:]:
+            log.info(f"evicting static build {path}")
+            path.unlink(missing_ok=True)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug(f"static server {format % args}")
+
+
+class StaticServer(object):
+    """Serves a static Storybook build on localhost from a thread, in place of
+    the start-storybook dev server"""
+
+    def __init__(self, directory):
+        handler = functools.partial(QuietHandler, directory=str(directory))
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,278 @@
+import asyncio
+import cProfile
+import hashlib
+import json
+import os
+import queue
+import secrets
+import signal
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from helpful_scripts import get_abs_path, log
+
+# where to export spans as OTLP JSON: appended to TRACE_FILE a line per batch
+# and/or POSTed to an OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces
+TRACE_FILE = os.environ.get("TRACE_FILE")
+if TRACE_FILE:
+    TRACE_FILE = str(get_abs_path(TRACE_FILE))
+TRACE_ENDPOINT = os.environ.get("TRACE_ENDPOINT")
+TRACE_SERVICE = os.environ.get("TRACE_SERVICE", "same-story-api")
+TRACING = bool(TRACE_FILE or TRACE_ENDPOINT)
+# how long in seconds to gather spans before exporting them together
+TRACE_EXPORT_SECS = float(os.environ.get("TRACE_EXPORT_SECS", 1))
+# profile the Python side of capturing each check, cprofile or py-spy
+PROFILE = os.environ.get("PROFILE", "")
+
+# OTLP span kinds
+INTERNAL = 1
+CLIENT = 3
+
+_current = ContextVar("span", default=None)
+
+
+def get_trace_id(check_id):
+    """Check IDs are UUIDs, so the trace of a check can be found by its ID"""
+    try:
+        return uuid.UUID(check_id).hex
+    except ValueError:
+        return hashlib.md5(check_id.encode()).hexdigest()
+
+
+def get_attributes(attributes):
+    def value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+
+    return [{"key": k, "value": value(v)} for k, v in attributes.items() if v is not None]
+
+
+class Span(object):
+    def __init__(self, trace_id, name, parent_id=None, kind=INTERNAL, start=None, **attributes):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns() if start is None else int(start * 1e9)
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, end=None):
+        self.end_ns = time.time_ns() if end is None else int(end * 1e9)
+        exporter.put(self)
+
+    def to_otlp(self):
+        d = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": get_attributes(self.attributes),
+        }
+        if self.parent_id:
+            d["parentSpanId"] = self.parent_id
+        if self.error:
+            d["status"] = {"code": 2, "message": self.error}
+        return d
+
+
+class Trace(object):
+    """The spans of one check, under a root span from when the check was
+    received until its message was deleted. A no-op unless TRACING."""
+
+    def __init__(self, check_id):
+        self.root = Span(get_trace_id(check_id), "check", check_id=check_id) if TRACING else None
+
+    @contextmanager
+    def activate(self):
+        """Spans started in this context, and in the tasks and threads it
+        starts, are children of the check"""
+        token = _current.set(self.root)
+        try:
+            yield
+        finally:
+            _current.reset(token)
+
+    def record(self, name, start, end, **attributes):
+        """A span that has already happened, e.g. waiting in a queue. The check
+        starts with the earliest."""
+        if self.root is not None:
+            self.root.start_ns = min(self.root.start_ns, int(start * 1e9))
+        record(self.root, name, start, end, **attributes)
+
+    def set(self, **attributes):
+        if self.root is not None:
+            self.root.set(**attributes)
+
+    def end(self):
+        if self.root is not None and self.root.end_ns is None:
+            self.root.end()
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def span(name, kind=INTERNAL, **attributes):
+    """A child of the current span, if there is one"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    s = Span(parent.trace_id, name, parent.span_id, kind, **attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+
+def record(parent, name, start, end, kind=INTERNAL, **attributes):
+    """A child of parent that started and ended at the given times"""
+    if parent is None:
+        return
+    Span(parent.trace_id, name, parent.span_id, kind, start=start, **attributes).end(end)
+
+
+class Exporter(object):
+    """Exports ended spans in batches from a thread of its own"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            # let the spans of a stage or a check gather
+            time.sleep(TRACE_EXPORT_SECS)
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            spans = [item for item in items if isinstance(item, Span)]
+            if spans:
+                try:
+                    self.export(spans)
+                except Exception as e:
+                    log.exception(e)
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def export(self, spans):
+        body = json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {"attributes": get_attributes({"service.name": TRACE_SERVICE})},
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": TRACE_SERVICE},
+                                "spans": [s.to_otlp() for s in spans],
+                            }
+                        ],
+                    }
+                ]
+            }
+        )
+        if TRACE_FILE:
+            with open(TRACE_FILE, "a") as fp:
+                fp.write(body + "\n")
+        if TRACE_ENDPOINT:
+            request = urllib.request.Request(
+                TRACE_ENDPOINT, body.encode(), headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request, timeout=10):
+                pass
+
+    def flush(self, timeout=10):
+        """Wait up to timeout seconds for the spans ended so far to be exported"""
+        if self.thread is None:
+            return
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        if not flushed.wait(timeout):
+            log.error(f"gave up exporting spans after {timeout} seconds")
+
+
+exporter = Exporter()
+
+
+def flush(timeout=10):
+    exporter.flush(timeout)
+
+
+class Profiler(object):
+    """Profiles the worker process while a check captures with PROFILE:
+    cprofile from inside, which also sees whatever else the event loop runs in
+    the meantime, or py-spy sampling from outside (it needs ptrace). The output
+    ends up at path."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.profile = None
+        self.proc = None
+
+    async def __aenter__(self):
+        if PROFILE == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif PROFILE == "py-spy":
+            self.path = self.directory / "profile.speedscope.json"
+            self.proc = await asyncio.create_subprocess_exec(
+                "py-spy",
+                "record",
+                "--pid",
+                str(os.getpid()),
+                "--format",
+                "speedscope",
+                "--output",
+                str(self.path),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+            self.path = self.directory / "profile.pstats"
+            self.profile.dump_stats(self.path)
+        elif self.proc is not None:
+            # py-spy writes its output when interrupted
+            try:
+                self.proc.send_signal(signal.SIGINT)
+                await asyncio.wait_for(self.proc.wait(), 10)
+            except (ProcessLookupError, asyncio.TimeoutError) as e:
+                log.error(f"py-spy didn't finish {e=}")
+        if self.path is not None and not self.path.exists():
+            self.path = None
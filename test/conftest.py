@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the worker modules import each other by name, as app.py runs them as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "same_story_api"))
@@ -0,0 +1,63 @@
+import json
+import sys
+
+import batch
+from batch import read_specs, summarize
+from helpful_scripts import LocalStorage
+
+STORY = {
+    "repository": "https://github.com/engi-network/figma-plugin.git",
+    "component": "Button",
+    "story": "Primary",
+}
+
+
+def write_specs(tmp_path, specs):
+    path = tmp_path / "specs.jsonl"
+    path.write_text("\n".join(json.dumps(spec_d) for spec_d in specs) + "\n\n")
+    return path
+
+
+def test_read_specs(tmp_path):
+    frame = tmp_path / "frame.png"
+    frame.write_bytes(b"png")
+    storage = LocalStorage(tmp_path / "storage")
+    path = write_specs(
+        tmp_path,
+        [
+            {**STORY, "check_id": "a", "frame": str(frame)},
+            {**STORY, "frame": str(frame)},
+            {**STORY, "check_id": "c", "frame": str(tmp_path / "missing.png")},
+            {**STORY, "check_id": "d"},
+        ],
+    )
+    (a, a_error), (b, b_error), (c, c_error), (d, d_error) = read_specs(path, storage)
+    assert a == {**STORY, "check_id": "a"} and a_error is None
+    assert storage.get("checks/a/frames/Primary.png") == b"png"
+    # a check_id is made up
+    assert b_error is None and b["check_id"] not in ("a", "c", "d")
+    assert storage.exists(f"checks/{b['check_id']}/frames/Primary.png")
+    assert isinstance(c_error, FileNotFoundError) and c["check_id"] == "c"
+    assert isinstance(d_error, KeyError) and d["check_id"] == "d"
+    assert not storage.exists("checks/c/") and not storage.exists("checks/d/")
+
+
+def test_summarize():
+    results = {**STORY, "check_id": "a", "mae": 0.1, "ssim": 0.9, "width": 800}
+    summary = summarize(results)
+    assert summary["mae"] == 0.1 and summary["ssim"] == 0.9
+    assert summary["completed_at"] is None
+    assert "width" not in summary
+    error = {**STORY, "check_id": "b", "error": {"install": "npm install failed"}, "mae": None}
+    assert summarize(error) == {**STORY, "check_id": "b", "error": error["error"]}
+
+
+def test_missing_frames_dont_stop_the_batch(monkeypatch, tmp_path):
+    specs = [{**STORY, "check_id": c, "frame": str(tmp_path / "missing.png")} for c in "ab"]
+    path, output = write_specs(tmp_path, specs), tmp_path / "summary.jsonl"
+    argv = ["batch.py", str(path), "--storage-dir", str(tmp_path / "storage")]
+    monkeypatch.setattr(sys, "argv", argv + ["--output", str(output)])
+    assert batch.main() == 1
+    summaries = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [s["check_id"] for s in summaries] == ["a", "b"]
+    assert all("frame" in s["error"] for s in summaries)
@@ -0,0 +1,88 @@
+import asyncio
+import gzip
+import json
+
+import check
+import pytest
+from check import CheckError, CheckRequest
+from compare import TILED_COMPARE_MIN_PIXELS, CompareError
+from helpful_scripts import LocalStorage
+
+
+@pytest.fixture(autouse=True)
+def tmpdir_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "tmp"))
+
+
+def make_check(tmp_path, **spec):
+    statuses = []
+
+    async def callback(msg):
+        statuses.append(msg)
+
+    spec_d = {"check_id": "a", "width": 800, "height": 600, **spec}
+    request = CheckRequest(spec_d, callback, storage=LocalStorage(tmp_path / "storage"))
+    request.screenshot = request.check_dir / "screenshot.png"
+    request.frame = request.check_dir / "frame.png"
+    return request, statuses
+
+
+def fake_identify(monkeypatch, sizes):
+    async def identify(path):
+        size = sizes[path.stem]
+        if isinstance(size, Exception):
+            raise size
+        return size
+
+    monkeypatch.setattr(check, "identify", identify)
+
+
+def test_tiled_compare_by_image_size(monkeypatch, tmp_path):
+    # a full-page screenshot much taller than its small viewport
+    request, _ = make_check(tmp_path)
+    tall = TILED_COMPARE_MIN_PIXELS // 800 + 1
+    fake_identify(monkeypatch, {"screenshot": (800, tall), "frame": (800, 600)})
+    assert asyncio.run(request.use_tiled_compare())
+    # the larger width by the larger height, as they are compared
+    fake_identify(monkeypatch, {"screenshot": (1, tall), "frame": (800, 1)})
+    assert asyncio.run(request.use_tiled_compare())
+    # a large viewport whose images are small
+    request, _ = make_check(tmp_path, width=4000, height=4000)
+    fake_identify(monkeypatch, {"screenshot": (800, 600), "frame": (800, 600)})
+    assert not asyncio.run(request.use_tiled_compare())
+
+
+def test_tiled_compare_forced(monkeypatch, tmp_path):
+    fake_identify(monkeypatch, {})
+    for tiled, expected in ("true", True), ("0", False), (True, True):
+        request, _ = make_check(tmp_path, tiled_compare=tiled)
+        assert asyncio.run(request.use_tiled_compare()) is expected
+
+
+def test_tiled_compare_unreadable_image(monkeypatch, tmp_path):
+    request, statuses = make_check(tmp_path)
+    fake_identify(monkeypatch, {"screenshot": (800, 600), "frame": CompareError("bad frame")})
+    with pytest.raises(CheckError) as e:
+        asyncio.run(request.use_tiled_compare())
+    assert e.value.e_key == "comp"
+    assert statuses[-1]["error"]["stderr"] == "bad frame"
+
+
+def test_log_url_in_results_and_status(tmp_path):
+    request, statuses = make_check(tmp_path)
+
+    async def main():
+        try:
+            await request.run_raise("echo installing; echo failed >&2; exit 1", e_key="install")
+        except CheckError as e:
+            await request.report_error(e)
+
+    asyncio.run(main())
+    storage = request.storage
+    log_key = "checks/a/report/logs/install-001.log.gz"
+    log_url = storage.get_url(log_key)
+    results = json.loads(storage.get("checks/a/report/results.json"))
+    assert results["error"]["log_url"] == log_url
+    assert results["error"]["stderr"] == "failed\n"
+    assert statuses[-1]["error"]["log_url"] == log_url
+    assert "installing" in gzip.decompress(storage.get(log_key)).decode()
@@ -0,0 +1,214 @@
+import asyncio
+import shutil
+import struct
+import zlib
+
+import numpy as np
+import pytest
+import compare
+from compare import BLOCK, BandReader, CompareError, PNGWriter, TiledComparison, label
+
+
+def read_png(path):
+    """Decode an 8-bit RGB PNG without filters, as written by PNGWriter"""
+    data = path.read_bytes()
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos, chunks = 8, []
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos : pos + 4])
+        tag, body = data[pos + 4 : pos + 8], data[pos + 8 : pos + 8 + length]
+        (crc,) = struct.unpack(">I", data[pos + 8 + length : pos + 12 + length])
+        assert crc == zlib.crc32(tag + body) & 0xFFFFFFFF
+        chunks.append((tag, body))
+        pos += 12 + length
+    assert chunks[0][0] == b"IHDR" and chunks[-1] == (b"IEND", b"")
+    width, height, depth, color_type = struct.unpack(">IIBB", chunks[0][1][:10])
+    assert (depth, color_type) == (8, 2)
+    raw = zlib.decompress(b"".join(body for tag, body in chunks if tag == b"IDAT"))
+    scanlines = np.frombuffer(raw, dtype=np.uint8).reshape(height, width * 3 + 1)
+    assert not scanlines[:, 0].any()
+    return scanlines[:, 1:].reshape(height, width, 3)
+
+
+def opaque(rows, width, value=255):
+    return np.full((rows, width, 4), value, dtype=np.uint8)
+
+
+def compare_bands(screenshot, frame, band_rows):
+    height, width = screenshot.shape[:2]
+    comparison = TiledComparison(width, height)
+    for top in range(0, height, band_rows):
+        comparison.update(
+            screenshot[top : top + band_rows], frame[top : top + band_rows], diff_images=False
+        )
+    return comparison.results()
+
+
+def test_label_connects_diagonals():
+    mask = np.array(
+        [
+            [1, 0, 0, 1],
+            [0, 1, 0, 0],
+            [0, 0, 0, 1],
+        ],
+        dtype=bool,
+    )
+    labels = label(mask)
+    assert labels[0, 0] == labels[1, 1] == 0
+    assert labels[0, 3] == 3
+    assert labels[2, 3] == 11
+    assert (labels[~mask] == mask.size).all()
+
+
+def test_label_long_chain():
+    mask = np.zeros((5, 40), dtype=bool)
+    mask[0, :] = mask[4, :] = True
+    mask[:, 39] = True
+    labels = label(mask)
+    assert (labels[mask] == 0).all()
+
+
+def test_identical_images():
+    band = opaque(20, 30)
+    results = compare_bands(band, band.copy(), band_rows=BLOCK)
+    assert results["mae"] == 0
+    assert results["ssim"] == 1.0
+    assert results["diff_pixels_pct"] == 0
+    assert results["diff_regions"] == []
+
+
+def test_changed_pixels():
+    screenshot = opaque(32, 32)
+    frame = screenshot.copy()
+    frame[10:12, 20:24, :3] = 0
+    results = compare_bands(screenshot, frame, band_rows=BLOCK)
+    assert results["mae"] == pytest.approx(8 / (32 * 32))
+    assert results["diff_pixels_pct"] == pytest.approx(100 * 8 / (32 * 32))
+    assert 0 < results["ssim"] < 1
+    assert results["diff_regions"] == [{"x": 20, "y": 10, "width": 4, "height": 2}]
+    assert results["MAE"].endswith(f"({results['mae']:g})")
+
+
+def test_regions_across_bands():
+    screenshot = opaque(64, 64)
+    frame = screenshot.copy()
+    # one region straddling the band edge at row 16 and a smaller one apart
+    frame[12:20, 4:10, :3] = 0
+    frame[40, 50, :3] = 0
+    for band_rows in (BLOCK, 2 * BLOCK, 64):
+        results = compare_bands(screenshot, frame, band_rows)
+        assert results["diff_regions"] == [
+            {"x": 4, "y": 12, "width": 6, "height": 8},
+            {"x": 50, "y": 40, "width": 1, "height": 1},
+        ]
+
+
+def test_transparent_pixels_are_white():
+    screenshot = opaque(8, 8)
+    frame = opaque(8, 8, value=0)
+    results = compare_bands(screenshot, frame, band_rows=BLOCK)
+    assert results["mae"] == 0
+    assert results["diff_regions"] == []
+
+
+def test_diff_images():
+    screenshot = opaque(8, 8)
+    frame = screenshot.copy()
+    frame[2, 3, :3] = 0
+    comparison = TiledComparison(8, 8)
+    gray, blue = comparison.update(screenshot, frame)
+    assert gray.shape == blue.shape == (8, 8, 3)
+    assert (gray[2, 3] == [255, 0, 0]).all()
+    assert (blue[2, 3] == [0, 0, 255]).all()
+    assert (blue[0, 0] == 255).all()
+
+
+def test_png_writer(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (37, 13, 3), dtype=np.uint8)
+    writer = PNGWriter(tmp_path / "image.png", 13, 37)
+    for top in range(0, 37, 10):
+        writer.write(image[top : top + 10])
+    writer.close()
+    assert (read_png(tmp_path / "image.png") == image).all()
+
+
+@pytest.mark.skipif(shutil.which("stream") is None, reason="needs ImageMagick")
+def test_band_reader_pads(tmp_path):
+    path = tmp_path / "image.png"
+    image = np.arange(5 * 3 * 3, dtype=np.uint8).reshape(5, 3, 3)
+    writer = PNGWriter(path, 3, 5)
+    writer.write(image)
+    writer.close()
+
+    async def read():
+        async with BandReader(path, 3, 5) as reader:
+            return [await reader.read(4, 4), await reader.read(4, 4)]
+
+    first, second = asyncio.run(read())
+    assert (first[:, :3, :3] == image[:4]).all()
+    assert (first[:, :3, 3] == 255).all()
+    assert not first[:, 3].any()
+    assert (second[0, :3, :3] == image[4]).all()
+    assert not second[1:].any()
+
+
+@pytest.mark.skipif(shutil.which("stream") is None, reason="needs ImageMagick")
+def test_band_reader_fails(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"not a png")
+
+    async def read():
+        async with BandReader(path, 3, 5) as reader:
+            await reader.read(4, 3)
+
+    with pytest.raises(CompareError):
+        asyncio.run(read())
+
+
+def whole_regions(changed):
+    """The bounding boxes of the changed regions, labelling the whole image"""
+    height, width = changed.shape
+    padded = np.zeros((-(-height // BLOCK) * BLOCK, -(-width // BLOCK) * BLOCK), dtype=bool)
+    padded[:height, :width] = changed
+    grid = padded.reshape(len(padded) // BLOCK, BLOCK, -1, BLOCK).any(axis=(1, 3))
+    labels = np.repeat(np.repeat(label(grid), BLOCK, axis=0), BLOCK, axis=1)
+    boxes = []
+    for component in np.unique(labels[padded]):
+        ys, xs = np.nonzero(padded & (labels == component))
+        x0, y0, x1, y1 = xs.min(), ys.min(), xs.max(), ys.max()
+        boxes.append({"x": x0, "y": y0, "width": x1 - x0 + 1, "height": y1 - y0 + 1})
+    return boxes
+
+
+def sorted_items(d):
+    return tuple(sorted((k, int(v)) for k, v in d.items()))
+
+
+def test_regions_match_whole_image(monkeypatch):
+    monkeypatch.setattr(compare, "MAX_DIFF_REGIONS", 1000)
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        screenshot = opaque(100, 70)
+        frame = screenshot.copy()
+        changed = rng.random((100, 70)) < 0.01
+        frame[changed, :3] = 0
+        expected = sorted(map(sorted_items, whole_regions(changed)))
+        for band_rows in (BLOCK, 3 * BLOCK, 100):
+            results = compare_bands(screenshot, frame, band_rows)
+            assert sorted(map(sorted_items, results["diff_regions"])) == expected
+
+
+def test_regions_largest_kept(monkeypatch):
+    monkeypatch.setattr(compare, "MAX_DIFF_REGIONS", 2)
+    screenshot = opaque(64, 64)
+    frame = screenshot.copy()
+    frame[0, 0, :3] = 0
+    frame[20:24, 20:24, :3] = 0
+    frame[40:42, 40:42, :3] = 0
+    frame[60, 60, :3] = 0
+    results = compare_bands(screenshot, frame, band_rows=BLOCK)
+    assert results["diff_regions"] == [
+        {"x": 20, "y": 20, "width": 4, "height": 4},
+        {"x": 40, "y": 40, "width": 2, "height": 2},
+    ]
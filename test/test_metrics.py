@@ -0,0 +1,77 @@
+import metrics
+import pytest
+from metrics import MAX_WAIT_TIME, Load
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metrics, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture(autouse=True)
+def adaptive(monkeypatch):
+    monkeypatch.setattr(metrics, "ADAPTIVE_POLLING", True)
+    monkeypatch.setattr(metrics, "TARGET_START_SECS", 120)
+
+
+def timed(prepare=None, capture=None, **kwargs):
+    load = Load(
+        **{"max_batch": 10, "wait_time": 5, "prefetch_depth": 1, "max_prefetch_depth": 3, **kwargs}
+    )
+    if prepare is not None:
+        load.record("prepare", prepare)
+    if capture is not None:
+        load.record("capture", capture)
+    return load
+
+
+def test_batch_size(monkeypatch):
+    assert timed().batch_size() == 10
+    assert timed(capture=60).batch_size() == 2
+    assert timed(capture=1000).batch_size() == 1
+    assert timed(capture=0.1).batch_size() == 10
+    monkeypatch.setattr(metrics, "ADAPTIVE_POLLING", False)
+    assert timed(capture=60).batch_size() == 10
+
+
+def test_wait_time(monkeypatch):
+    assert timed().wait_time() == 5
+    assert timed(capture=7.4).wait_time() == 7
+    assert timed(capture=0.2).wait_time() == 1
+    assert timed(capture=100).wait_time() == MAX_WAIT_TIME
+    monkeypatch.setattr(metrics, "ADAPTIVE_POLLING", False)
+    assert timed(capture=7.4).wait_time() == 5
+
+
+def test_prefetch_depth(monkeypatch):
+    # until both stages have been timed
+    assert timed(prepare=30).prefetch_depth() == 1
+    assert timed(prepare=30, capture=15).prefetch_depth() == 2
+    assert timed(prepare=100, capture=10).prefetch_depth() == 3
+    assert timed(prepare=5, capture=10).prefetch_depth() == 1
+    # 0 turns prefetching off whatever the durations
+    assert timed(prepare=100, capture=10, prefetch_depth=0).prefetch_depth() == 0
+    monkeypatch.setattr(metrics, "ADAPTIVE_POLLING", False)
+    assert timed(prepare=100, capture=10).prefetch_depth() == 1
+
+
+def test_busy_fraction(clock):
+    load = timed()
+    clock[0] += 10
+    assert load.busy_fraction() == 0
+    load.start_capture()
+    clock[0] += 6
+    load.end_capture()
+    clock[0] += 4
+    assert load.busy_fraction() == pytest.approx(0.6)
+    # a capture running across samples counts in each
+    clock[0] += 2
+    load.start_capture()
+    clock[0] += 8
+    assert load.busy_fraction() == pytest.approx(0.8)
+    clock[0] += 5
+    load.end_capture()
+    clock[0] += 5
+    assert load.busy_fraction() == pytest.approx(0.5)
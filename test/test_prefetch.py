@@ -0,0 +1,116 @@
+import asyncio
+from collections import namedtuple
+from time import time
+
+import app
+import pytest
+from app import Prefetch, prefetcher
+from queues import FairScheduler, Job, JobQueue
+from tracing import Trace
+
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+class FakeLoad(object):
+    def __init__(self, depth):
+        self.depth = depth
+        self.recorded = []
+
+    def prefetch_depth(self):
+        return self.depth
+
+    def record(self, name, secs):
+        self.recorded.append(name)
+
+
+class FakeCheck(object):
+    def __init__(self, check_id, prepared):
+        self.spec_d = {"check_id": check_id}
+        self.trace = Trace(check_id)
+        self.error = None
+        self.prepared = prepared
+
+    async def prepare(self):
+        self.prepared.append(self.spec_d["check_id"])
+
+
+@pytest.fixture(autouse=True)
+def room(monkeypatch):
+    """Set free to the bytes of disk and memory the tests have"""
+    free = {"disk": 2 * app.PREFETCH_MIN_FREE_DISK, "memory": 2 * app.PREFETCH_MIN_FREE_MEMORY}
+    monkeypatch.setattr(app, "PREFETCH_POLL_SECS", 0.01)
+    monkeypatch.setattr(app.shutil, "disk_usage", lambda path: DiskUsage(0, 0, free["disk"]))
+    monkeypatch.setattr(app, "get_free_memory", lambda: free["memory"])
+    return free
+
+
+async def acquired(prefetch):
+    """Whether prefetch.acquire() goes ahead without waiting for a release"""
+    try:
+        await asyncio.wait_for(prefetch.acquire(), 0.1)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def test_depth_bound():
+    async def main():
+        load = FakeLoad(depth=2)
+        prefetch = Prefetch(load)
+        # the check being captured, then two prepared ahead of it
+        assert [await acquired(prefetch) for _ in range(4)] == [True, True, True, False]
+        prefetch.release()
+        assert await acquired(prefetch)
+        # depth follows the load
+        load.depth = 3
+        assert await acquired(prefetch)
+        assert prefetch.in_flight == 4
+
+    asyncio.run(main())
+
+
+def test_depth_zero_is_sequential():
+    async def main():
+        prepared = []
+        job_queue = JobQueue(None, "url", "q")
+        scheduler = FairScheduler([job_queue])
+        for check_id in "abc":
+            scheduler.put(Job(job_queue, FakeCheck(check_id, prepared), check_id, time()))
+        load, ready = FakeLoad(depth=0), asyncio.Queue()
+        prefetch = Prefetch(load)
+        task = asyncio.create_task(prefetcher(scheduler, ready, prefetch, load))
+        try:
+            captured = []
+            for _ in range(3):
+                job = await asyncio.wait_for(ready.get(), 1)
+                await asyncio.sleep(0.05)
+                # nothing is prepared while a check is being captured
+                assert prepared == captured + [job.check.spec_d["check_id"]]
+                captured = list(prepared)
+                prefetch.release()
+        finally:
+            task.cancel()
+        return prepared, load
+
+    prepared, load = asyncio.run(main())
+    assert prepared == ["a", "b", "c"]
+    assert load.recorded == ["prepare"] * 3
+
+
+def test_room_only_gates_prefetching(room):
+    room["memory"] = app.PREFETCH_MIN_FREE_MEMORY - 1
+
+    async def main():
+        prefetch = Prefetch(FakeLoad(depth=2))
+        # with nothing in flight a check goes ahead however little room is left
+        assert await acquired(prefetch)
+        assert not await acquired(prefetch)
+        room["memory"] = app.PREFETCH_MIN_FREE_MEMORY
+        room["disk"] = app.PREFETCH_MIN_FREE_DISK - 1
+        assert not await acquired(prefetch)
+        prefetch.release()
+        assert await acquired(prefetch)
+        room["disk"] = app.PREFETCH_MIN_FREE_DISK
+        assert await acquired(prefetch)
+
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+import asyncio
+import gzip
+import signal
+from time import time
+
+from procs import OUTPUT_HEAD_BYTES, OUTPUT_TAIL_BYTES, OutputBuffer, Processes, truncate
+
+
+def test_kill_process_group(tmp_path):
+    async def main():
+        procs = Processes(tmp_path)
+        # the background sleep keeps the pipes open unless its group is killed
+        run = asyncio.create_task(procs.run("sleep 30 & sleep 30"))
+        await asyncio.sleep(0.5)
+        started = time()
+        procs.kill()
+        cmd_exit = await asyncio.wait_for(run, 5)
+        return procs, cmd_exit, time() - started, await procs.run("echo late")
+
+    procs, cmd_exit, secs, late = asyncio.run(main())
+    assert cmd_exit.returncode == -signal.SIGKILL
+    assert secs < 5
+    assert not procs.running
+    assert late.returncode == -signal.SIGKILL
+    assert late.log_path is None
+
+
+def test_output_buffer_keeps_head_and_tail():
+    buffer = OutputBuffer(head=4, tail=6)
+    for chunk in b"ab", b"cdef", b"ghijklmnop":
+        buffer.write(chunk)
+    assert buffer.omitted == 6
+    assert buffer.getvalue() == "abcd\n... 6 bytes omitted ...\nklmnop"
+    short = OutputBuffer(head=4, tail=6)
+    short.write(b"abcdefgh")
+    assert short.getvalue() == "abcdefgh"
+
+
+def test_truncate():
+    assert truncate(None) is None
+    assert truncate("short") == "short"
+    text = "h" * OUTPUT_HEAD_BYTES + "x" * 100 + "t" * OUTPUT_TAIL_BYTES
+    assert truncate(text) == (
+        "h" * OUTPUT_HEAD_BYTES + "\n... 100 bytes omitted ...\n" + "t" * OUTPUT_TAIL_BYTES
+    )
+
+
+def test_run_spills_full_output(tmp_path):
+    # more of each stream than is kept in memory
+    lines = 2 * (OUTPUT_HEAD_BYTES + OUTPUT_TAIL_BYTES) // len("out0000\n")
+    cmd = f"for i in $(seq 1000 {999 + lines}); do echo out$i; echo err$i >&2; done"
+    cmd_exit = asyncio.run(Processes(tmp_path).run(cmd))
+    assert cmd_exit.returncode == 0
+    assert cmd_exit.stdout.startswith("out1000\nout1001\n")
+    assert cmd_exit.stdout.endswith(f"out{999 + lines}\n")
+    assert "bytes omitted" in cmd_exit.stdout and "bytes omitted" in cmd_exit.stderr
+    with gzip.open(cmd_exit.log_path, "rt") as spill:
+        spilled = spill.read().splitlines()
+    # the command, then all of both streams as they arrived
+    assert spilled[0] == f"$ {cmd}"
+    for stream in "out", "err":
+        assert [line for line in spilled if line.startswith(stream)] == [
+            f"{stream}{i}" for i in range(1000, 1000 + lines)
+        ]
+    assert len(spilled) == 1 + 2 * lines
@@ -0,0 +1,203 @@
+import asyncio
+import json
+
+import publisher
+import pytest
+from publisher import BATCH_BYTES, BATCH_ENTRIES, StatusPublisher, get_batches
+
+
+class ClientError(Exception):
+    """Like botocore's, with the error code in response"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeSNS(object):
+    """Records what was published. failures is a list, one item per
+    publish_batch call, of the entry Ids to fail or an exception to raise."""
+
+    def __init__(self, failures=(), fail_topics=(), dead_topics=()):
+        self.failures = list(failures)
+        self.fail_topics = set(fail_topics)
+        self.dead_topics = set(dead_topics)
+        self.batches = []
+        self.published = []
+
+    async def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append((TopicArn, [e["Message"] for e in PublishBatchRequestEntries]))
+        if TopicArn in self.fail_topics:
+            raise ClientError("InternalError")
+        if TopicArn in self.dead_topics:
+            raise ClientError("NotFound")
+        failure = self.failures.pop(0) if self.failures else []
+        if isinstance(failure, Exception):
+            raise failure
+        ok = [e for e in PublishBatchRequestEntries if e["Id"] not in failure]
+        self.published.extend((TopicArn, e["Message"]) for e in ok)
+        return {
+            "Successful": [{"Id": e["Id"]} for e in ok],
+            "Failed": [{"Id": i, "Code": "InternalError"} for i in failure],
+        }
+
+    async def publish(self, TopicArn, Message, **kwargs):
+        self.published.append((TopicArn, Message))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(publisher, "STATUS_PUBLISH_BACKOFF", 0)
+
+
+def updates(check_id, steps, step_count=8):
+    spec_d = {"check_id": check_id, "sns_topic_arn": f"arn:{check_id}"}
+    for step in steps:
+        msg = {"check_id": check_id, "step": step, "step_count": step_count}
+        yield spec_d, msg, json.dumps(msg), None
+
+
+def published_steps(sns, topic_arn):
+    return [json.loads(m)["step"] for t, m in sns.published if t == topic_arn]
+
+
+def test_batches_by_count():
+    entries = [{"Message": str(i)} for i in range(25)]
+    batches = list(get_batches(entries))
+    assert [len(b) for b in batches] == [BATCH_ENTRIES, BATCH_ENTRIES, 5]
+    assert [e for b in batches for e in b] == entries
+
+
+def test_batches_by_size():
+    big = {"Message": "x" * (BATCH_BYTES // 2)}
+    small = {"Message": "y"}
+    batches = list(get_batches([big, big, small, {"Message": "z" * (BATCH_BYTES + 1)}, small]))
+    assert [len(b) for b in batches] == [2, 1, 1, 1]
+    assert list(get_batches([])) == []
+
+
+def test_resend_from_first_failure():
+    async def main():
+        sns = FakeSNS(failures=[["1", "3"]])
+        entries = [{"Message": str(i)} for i in range(5)]
+        await StatusPublisher(sns).publish_batch("arn:a", entries)
+        return sns
+
+    sns = asyncio.run(main())
+    assert sns.batches[0][1] == ["0", "1", "2", "3", "4"]
+    # everything from the first failed entry again, so nothing overtakes it
+    assert sns.batches[1][1] == ["1", "2", "3", "4"]
+    assert [m for _, m in sns.published] == ["0", "2", "4", "1", "2", "3", "4"]
+
+
+def test_updates_in_order_per_check():
+    async def main():
+        sns = FakeSNS(failures=[["0"], ["2"]])
+        p = StatusPublisher(sns)
+        a, b = list(updates("a", range(8))), list(updates("b", range(3)))
+        interleaved = [a[0], a[1], b[0], a[2], b[1], b[2], *a[3:]]
+        await p.publish_updates(interleaved)
+        return sns, p
+
+    sns, p = asyncio.run(main())
+    for topic_arn, count in ("arn:a", 8), ("arn:b", 3):
+        # resent updates repeat, but the last copy of each comes after those of
+        # the updates before it
+        last_copies = list(dict.fromkeys(reversed(published_steps(sns, topic_arn))))
+        assert last_copies[::-1] == list(range(count))
+    # the last update of a forgets its topic
+    assert "a" not in p.topics
+
+
+def test_failing_topic_doesnt_drop_others(monkeypatch):
+    monkeypatch.setattr(publisher, "STATUS_PUBLISH_TRIES", 2)
+
+    async def main():
+        sns = FakeSNS(fail_topics=["arn:a"])
+        p = StatusPublisher(sns)
+        p.topics["a"] = "arn:a"
+        await p.publish_updates([*updates("a", [7]), *updates("b", [0, 1])])
+        return sns, p
+
+    sns, p = asyncio.run(main())
+    assert published_steps(sns, "arn:b") == [0, 1]
+    assert published_steps(sns, "arn:a") == []
+    assert "a" not in p.topics
+    assert "arn:a" not in p.no_batch
+
+
+def test_fallback_only_when_unsupported():
+    async def main():
+        sns = FakeSNS(failures=[ClientError("Throttling"), ClientError("InvalidAction")])
+        p = StatusPublisher(sns)
+        await p.publish_batch("arn:a", [{"Message": "0"}, {"Message": "1"}])
+        return sns, p
+
+    sns, p = asyncio.run(main())
+    # throttled, retried, then given up on in favour of publish
+    assert len(sns.batches) == 2
+    assert p.no_batch == {"arn:a"}
+    assert [m for _, m in sns.published] == ["0", "1"]
+
+
+def test_throttling_keeps_batching():
+    async def main():
+        sns = FakeSNS(failures=[ClientError("Throttling")])
+        p = StatusPublisher(sns)
+        await p.publish_batch("arn:a", [{"Message": "0"}])
+        return sns, p
+
+    sns, p = asyncio.run(main())
+    assert p.no_batch == set()
+    assert len(sns.batches) == 2
+    assert [m for _, m in sns.published] == ["0"]
+
+
+def test_run_keeps_going(monkeypatch):
+    monkeypatch.setattr(publisher, "STATUS_PUBLISH_TRIES", 1)
+
+    async def main():
+        sns = FakeSNS(fail_topics=["arn:a"])
+        p = StatusPublisher(sns).start()
+        p.topics["a"] = "arn:a"
+        for spec_d, msg, _, _ in [*updates("a", [0]), *updates("b", [0])]:
+            await p.publish(spec_d, msg)
+        await p.close(timeout=5)
+        return sns
+
+    sns = asyncio.run(main())
+    assert published_steps(sns, "arn:b") == [0]
+
+
+def test_failing_topic_published_concurrently(monkeypatch):
+    monkeypatch.setattr(publisher, "STATUS_PUBLISH_TRIES", 3)
+    monkeypatch.setattr(publisher, "STATUS_PUBLISH_BACKOFF", 0.01)
+
+    async def main():
+        sns = FakeSNS(fail_topics=["arn:a"])
+        await StatusPublisher(sns).publish_updates([*updates("a", [0]), *updates("b", [0])])
+        return sns
+
+    sns = asyncio.run(main())
+    # b went out while a was backing off
+    assert [t for t, _ in sns.batches] == ["arn:a", "arn:b", "arn:a", "arn:a"]
+    assert published_steps(sns, "arn:b") == [0]
+
+
+def test_dead_topic_fails_fast_and_is_skipped():
+    async def main():
+        sns = FakeSNS(dead_topics=["arn:a"])
+        p = StatusPublisher(sns)
+        a, b = list(updates("a", [0, 1, 7])), list(updates("b", [0, 1]))
+        await p.publish_updates([a[0], b[0]])
+        assert p.dead_topics == {"arn:a"}
+        await p.publish_updates([a[1], b[1]])
+        await p.publish_updates([a[2]])
+        return sns, p
+
+    sns, p = asyncio.run(main())
+    # not retried, and nothing more sent to it until its check ended
+    assert [t for t, _ in sns.batches] == ["arn:a", "arn:b", "arn:b"]
+    assert published_steps(sns, "arn:b") == [0, 1]
+    assert p.dead_topics == set()
+    assert "a" not in p.topics
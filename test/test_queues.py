@@ -0,0 +1,154 @@
+import asyncio
+from time import time
+
+import pytest
+import queues
+from queues import FairScheduler, Job, JobQueue, QueueStats
+
+
+class FakeSQS(object):
+    def __init__(self):
+        self.visibility = []
+        self.deleted = []
+
+    async def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.visibility.append([(e["ReceiptHandle"], e["VisibilityTimeout"]) for e in Entries])
+        return {"Successful": [{"Id": e["Id"]} for e in Entries]}
+
+    async def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+        return {}
+
+
+def make_jobs(job_queue, n):
+    return [Job(job_queue, None, f"{job_queue.name}-{i}", time()) for i in range(n)]
+
+
+def test_weighted_order():
+    async def main():
+        interactive = JobQueue(None, "url-i", "interactive", weight=4)
+        bulk = JobQueue(None, "url-b", "bulk", weight=1)
+        scheduler = FairScheduler([interactive, bulk])
+        for job in make_jobs(interactive, 20) + make_jobs(bulk, 20):
+            scheduler.put(job)
+        return [(await scheduler.get()).job_queue.name for _ in range(10)]
+
+    names = asyncio.run(main())
+    assert names.count("interactive") == 8
+    assert names.count("bulk") == 2
+
+
+def test_in_order_within_queue():
+    async def main():
+        job_queue = JobQueue(None, "url", "q")
+        scheduler = FairScheduler([job_queue])
+        jobs = make_jobs(job_queue, 5)
+        for job in jobs:
+            scheduler.put(job)
+        return jobs, [await scheduler.get() for _ in jobs]
+
+    jobs, started = asyncio.run(main())
+    assert started == jobs
+
+
+def test_idle_queue_doesnt_catch_up():
+    async def main():
+        busy = JobQueue(None, "url-1", "busy")
+        idle = JobQueue(None, "url-2", "idle")
+        scheduler = FairScheduler([busy, idle])
+        for job in make_jobs(busy, 10):
+            scheduler.put(job)
+        for _ in range(5):
+            await scheduler.get()
+        for job in make_jobs(idle, 5):
+            scheduler.put(job)
+        return [(await scheduler.get()).job_queue.name for _ in range(4)]
+
+    # the idle queue joins at the current virtual time and then takes turns
+    names = asyncio.run(main())
+    assert names.count("idle") == 2
+    assert names.count("busy") == 2
+
+
+def test_get_waits_for_put():
+    async def main():
+        job_queue = JobQueue(None, "url", "q")
+        scheduler = FairScheduler([job_queue])
+        get = asyncio.create_task(scheduler.get())
+        await asyncio.sleep(0)
+        assert not get.done()
+        (job,) = make_jobs(job_queue, 1)
+        scheduler.put(job)
+        return job, await asyncio.wait_for(get, 1)
+
+    job, got = asyncio.run(main())
+    assert got is job
+    assert job.job_queue.stats.started == 1
+
+
+def test_percentiles():
+    assert QueueStats.percentiles([]) == {"p50": None, "p95": None, "max": None}
+    assert QueueStats.percentiles([2.0]) == {"p50": 2.0, "p95": 2.0, "max": 2.0}
+    waits = [float(i) for i in range(1, 101)]
+    p = QueueStats.percentiles(waits)
+    assert p["p50"] == pytest.approx(50.5)
+    assert p["p95"] == pytest.approx(95.05)
+    assert p["max"] == 100.0
+
+
+def test_stats_window(monkeypatch):
+    monkeypatch.setattr(queues, "QUEUE_STATS_WINDOW", 3)
+
+    async def main():
+        job_queue = JobQueue(None, "url", "q")
+        stats = job_queue.stats
+        stats.received = 5
+        for job in make_jobs(job_queue, 5):
+            job.sent_at -= 10
+            stats.start(job)
+        return stats
+
+    stats = asyncio.run(main())
+    summary = stats.summary()
+    assert summary["received"] == summary["started"] == 5
+    assert len(stats.waits) == len(stats.local_waits) == 3
+    assert 10 <= summary["wait"]["p50"] < 11
+    assert 0 <= summary["local_wait"]["max"] < 1
+
+
+def test_heartbeat_until_done(monkeypatch):
+    monkeypatch.setattr(queues, "VISIBILITY_HEARTBEAT_SECS", 0.01)
+    monkeypatch.setattr(queues, "VISIBILITY_TIMEOUT", 120)
+
+    async def main():
+        sqs = FakeSQS()
+        job_queue = JobQueue(sqs, "url", "q", max_in_flight=20)
+        jobs = make_jobs(job_queue, 12)
+        job_queue.jobs.update(jobs)
+        job_queue.in_flight = len(jobs)
+        heartbeat = asyncio.create_task(job_queue.heartbeat())
+        await asyncio.sleep(0.05)
+        for job in jobs[:11]:
+            await job.done()
+        sqs.visibility.clear()
+        await asyncio.sleep(0.05)
+        heartbeat.cancel()
+        await job_queue.release()
+        return sqs, jobs
+
+    sqs, jobs = asyncio.run(main())
+    assert sqs.deleted == [job.receipt_handle for job in jobs[:11]]
+    # only the job that isn't done is kept invisible, then released
+    assert sqs.visibility[0] == [(jobs[11].receipt_handle, 120)]
+    assert sqs.visibility[-1] == [(jobs[11].receipt_handle, 0)]
+
+
+def test_heartbeat_batches():
+    async def main():
+        sqs = FakeSQS()
+        job_queue = JobQueue(sqs, "url", "q")
+        await job_queue.change_visibility(make_jobs(job_queue, 23), 60)
+        return sqs
+
+    sqs = asyncio.run(main())
+    assert [len(entries) for entries in sqs.visibility] == [10, 10, 3]
@@ -0,0 +1,141 @@
+import asyncio
+import json
+
+import pytest
+from app import CheckRegistry
+from check import CheckRequest
+from helpful_scripts import LocalStorage, get_cancel_key, get_latest, get_latest_key
+from queues import Job
+
+STORY = {
+    "repository": "https://github.com/engi-network/figma-plugin.git",
+    "component": "Button",
+    "story": "Primary",
+}
+
+
+@pytest.fixture(autouse=True)
+def tmpdir_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "tmp"))
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(tmp_path / "storage")
+
+
+def make_job(storage, check_id, sent_at, story=STORY):
+    spec_d = {**story, "check_id": check_id}
+    check = CheckRequest(spec_d, None, storage=storage, sent_at=sent_at)
+    return Job(None, check, f"receipt-{check_id}", sent_at)
+
+
+def cancelled(job):
+    e = job.check.cancelled
+    return e and (e.e_key, e.details.get("superseded_by"))
+
+
+def test_supersede_by_sent_at(storage):
+    async def main():
+        registry = CheckRegistry(storage)
+        older, newer = make_job(storage, "a", 100), make_job(storage, "b", 200)
+        other = make_job(storage, "c", 50, story={**STORY, "story": "Secondary"})
+        for job in older, newer, other:
+            await registry.add(job)
+        return older, newer, other
+
+    older, newer, other = asyncio.run(main())
+    assert cancelled(older) == ("superseded", "b")
+    assert not newer.check.cancelled
+    assert not other.check.cancelled
+    assert get_latest(storage, STORY) == {"check_id": "b", "sent_at": 200}
+
+
+def test_out_of_order_arrival(storage):
+    async def main():
+        registry = CheckRegistry(storage)
+        newer, older = make_job(storage, "b", 200), make_job(storage, "a", 100)
+        await registry.add(newer)
+        await registry.add(older)
+        # and on another worker, sharing the storage
+        elsewhere = make_job(storage, "z", 50)
+        await CheckRegistry(storage).add(elsewhere)
+        return newer, older, elsewhere
+
+    newer, older, elsewhere = asyncio.run(main())
+    assert not newer.check.cancelled
+    assert cancelled(older) == ("superseded", "b")
+    assert cancelled(elsewhere) == ("superseded", "b")
+    assert get_latest(storage, STORY) == {"check_id": "b", "sent_at": 200}
+
+
+def test_superseded_on_another_worker(storage):
+    async def main():
+        older, newer = make_job(storage, "a", 100), make_job(storage, "b", 200)
+        await CheckRegistry(storage).add(older)
+        await CheckRegistry(storage).add(newer)
+        await older.check.check_markers()
+        await newer.check.check_markers()
+        return older, newer
+
+    older, newer = asyncio.run(main())
+    assert cancelled(older) == ("superseded", "b")
+    assert not newer.check.cancelled
+
+
+def test_missing_or_stale_marker_doesnt_cancel(storage):
+    async def main():
+        job = make_job(storage, "a", 100)
+        await job.check.check_markers()
+        assert not job.check.cancelled
+        # an older check wrote its marker last, racing with this one
+        storage.put(get_latest_key(STORY), json.dumps({"check_id": "z", "sent_at": 50}))
+        await job.check.check_markers()
+        assert not job.check.cancelled
+        # a check that wasn't queued, e.g. from batch.py, has nothing to compare
+        storage.put(get_latest_key(STORY), json.dumps({"check_id": "b", "sent_at": 200}))
+        unqueued = make_job(storage, "c", None)
+        await unqueued.check.check_markers()
+        assert not unqueued.check.cancelled
+        await job.check.check_markers()
+        return job
+
+    job = asyncio.run(main())
+    assert cancelled(job) == ("superseded", "b")
+
+
+def test_redelivery(storage):
+    async def main():
+        registry = CheckRegistry(storage)
+        job = make_job(storage, "a", 100)
+        await registry.add(job)
+        assert registry.redelivered("a", "receipt-again")
+        assert not registry.redelivered("b", "receipt-b")
+        registry.remove(job)
+        assert not registry.redelivered("a", "receipt-later")
+        await asyncio.wait_for(registry.drained(), 1)
+        return job, registry
+
+    job, registry = asyncio.run(main())
+    # SQS deletes the message by the latest receipt handle
+    assert job.receipt_handle == "receipt-again"
+    assert not job.check.cancelled
+    assert registry.stories == {}
+
+
+def test_explicit_cancel(storage):
+    async def main():
+        registry = CheckRegistry(storage)
+        here = make_job(storage, "a", 100)
+        await registry.add(here)
+        await registry.cancel("a")
+        # cancelled before another worker received it, or while running there
+        await registry.cancel("b")
+        elsewhere = make_job(storage, "b", 200, story={**STORY, "story": "Secondary"})
+        await elsewhere.check.check_markers()
+        return here, elsewhere
+
+    here, elsewhere = asyncio.run(main())
+    assert cancelled(here) == ("cancelled", None)
+    assert cancelled(elsewhere) == ("cancelled", None)
+    assert storage.exists(get_cancel_key("b"))
@@ -0,0 +1,96 @@
+import pytest
+from helpful_scripts import ResultsIndex
+
+STORY = {
+    "repository": "https://github.com/engi-network/figma-plugin.git",
+    "component": "Button",
+    "story": "Primary",
+}
+
+
+def results(check_id, head_commit, completed_at, mae=0.1, **kwargs):
+    return {
+        **STORY,
+        "check_id": check_id,
+        "branch": "main",
+        "head_commit": head_commit,
+        "width": 800,
+        "height": 600,
+        "created_at": completed_at - 60,
+        "completed_at": completed_at,
+        "mae": mae,
+        "ssim": 0.9,
+        "diff_pixels_pct": 1.5,
+        **kwargs,
+    }
+
+
+def test_add_and_history():
+    index = ResultsIndex()
+    index.add(results("a", "1111aaaa", 100, commit="1111", github_token="secret"))
+    index.add(results("b", "2222bbbb", 200))
+    history = index.history(STORY["repository"])
+    assert [r["check_id"] for r in history] == ["b", "a"]
+    assert "github_token" not in history[1]
+    assert "secret" not in index.db.execute("SELECT results FROM results").fetchall()[0][0]
+    assert index.history(**STORY, branch="main", limit=1)[0]["check_id"] == "b"
+    assert index.history(STORY["repository"], component="Other") == []
+
+
+def test_history_by_commit():
+    index = ResultsIndex()
+    # the spec gave a short SHA, or no commit for the head of the branch
+    index.add(results("a", "1111aaaa", 100, commit="1111"))
+    index.add(results("b", "1111aaaa", 200))
+    index.add(results("c", "2222bbbb", 300))
+    by_short = index.history(STORY["repository"], commit="1111")
+    by_full = index.history(STORY["repository"], commit="1111aaaa")
+    assert [r["check_id"] for r in by_short] == [r["check_id"] for r in by_full] == ["b", "a"]
+
+
+def test_add_replaces_and_indexes_errors():
+    index = ResultsIndex()
+    index.add(results("a", "1111aaaa", 100))
+    # failed before checking out: no head_commit, no metrics, no completed_at
+    error = {**STORY, "check_id": "a", "commit": "1111", "error": {"install": "npm install failed"}}
+    index.add(error)
+    (row,) = index.db.execute('SELECT "commit", error, mae, completed_at FROM results')
+    assert row["commit"] == "1111"
+    assert row["error"] == "install"
+    assert row["mae"] is None
+    assert row["completed_at"] is not None
+
+
+def test_trend():
+    index = ResultsIndex()
+    index.add(results("a", "1111aaaa", 100, mae=0.3, commit="1111"))
+    index.add(results("b", "1111aaaa", 200, mae=0.2))
+    index.add(results("c", "2222bbbb", 300, mae=0.1))
+    index.add(results("d", "3333cccc", 400, mae=None, error={"comp": "failed"}))
+    index.add(results("e", None, 500, mae=0.4))
+    assert index.trend(**STORY) == [
+        ("1111aaaa", 200, 0.2),
+        ("2222bbbb", 300, 0.1),
+        (None, 500, 0.4),
+    ]
+    assert [value for _, _, value in index.trend(**STORY, metric="ssim")] == [0.9, 0.9, 0.9]
+    with pytest.raises(ValueError):
+        index.trend(**STORY, metric="results")
+
+
+def test_merge(tmp_path):
+    shards = []
+    for n, checks in enumerate([[("a", 100), ("b", 200)], [("b", 250), ("c", 300)]]):
+        shard = ResultsIndex(tmp_path / f"shard-{n}.sqlite")
+        for check_id, completed_at in checks:
+            shard.add(results(check_id, f"{check_id}000", completed_at))
+        shards.append(shard.snapshot(tmp_path / f"snapshot-{n}.sqlite"))
+    index = ResultsIndex()
+    for shard in shards:
+        index.merge(shard)
+    history = index.history(STORY["repository"])
+    assert [(r["check_id"], r["completed_at"]) for r in history] == [
+        ("c", 300),
+        ("b", 250),
+        ("a", 100),
+    ]
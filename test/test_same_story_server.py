@@ -15,11 +15,11 @@ _ = lambda s: s
 STATUS_MESSAGES = [
     (_("job started"), ("created_at",)),
     (_("downloaded Figma check frame"), ("url_check_frame",)),
-    (_("checked out code"), ("code_paths", "code_size", "code_snippets")),
+    (_("checked out code"), ("code_paths", "code_size", "code_snippets", "head_commit")),
     (_("installed packages"), ()),
     (_("captured screenshots"), ("url_screenshot",)),
     (_("completed visual comparisons"), ()),
-    (_("completed numeric comparisons"), ("MAE",)),
+    (_("completed numeric comparisons"), ("MAE", "mae", "ssim", "diff_pixels_pct", "diff_regions")),
     (_("uploaded screenshots"), ("url_blue_difference", "url_gray_difference", "completed_at")),
 ]
 
@@ -232,6 +232,11 @@ def test_should_be_able_to_successfully_run_check(success_results):
     # screenshot captured by storycap
     mae = float(results["MAE"].split()[0])
     assert mae < 50.0
+    assert 0 <= results["mae"] < 1
+    assert 0 <= results["ssim"] <= 1
+    assert 0 <= results["diff_pixels_pct"] <= 100
+    for region in results["diff_regions"]:
+        assert set(region.keys()) == {"x", "y", "width", "height"}
     # check timestamps
     duration = results["completed_at"] - results["created_at"]
     assert duration > 0 and duration < 200
@@ -0,0 +1,55 @@
+from helpful_scripts import LocalStorage
+
+
+def make_storage(tmp_path):
+    storage = LocalStorage(tmp_path / "storage")
+    for key in "checks/a/report/results.json", "checks/a/frames/Primary.png", "checks/ab/x":
+        storage.put(key, key)
+    return storage
+
+
+def test_list_and_exists(tmp_path):
+    storage = make_storage(tmp_path)
+    assert list(storage.list("checks/a/")) == [
+        "checks/a/frames/Primary.png",
+        "checks/a/report/results.json",
+    ]
+    # a prefix, not a directory
+    assert list(storage.list("checks/a")) == [
+        "checks/a/frames/Primary.png",
+        "checks/a/report/results.json",
+        "checks/ab/x",
+    ]
+    assert list(storage.list("checks/b")) == []
+    assert list(storage.list("nothing/here/")) == []
+    assert storage.exists("checks/a/report/results.json")
+    assert storage.exists("checks/a/report")
+    assert not storage.exists("checks/a/report/missing.json")
+    assert storage.get("checks/ab/x") == b"checks/ab/x"
+
+
+def test_upload_and_download_dir(tmp_path):
+    storage = make_storage(tmp_path)
+    local = tmp_path / "local"
+    (local / "nested").mkdir(parents=True)
+    (local / "one.txt").write_text("1")
+    (local / "nested" / "two.txt").write_text("2")
+    storage.upload_dir(local, "checks/a/upload")
+    assert list(storage.list("checks/a/upload/")) == [
+        "checks/a/upload/nested/two.txt",
+        "checks/a/upload/one.txt",
+    ]
+    storage.download_dir("checks/a", tmp_path / "check")
+    assert (tmp_path / "check" / "upload" / "nested" / "two.txt").read_text() == "2"
+    assert (tmp_path / "check" / "report" / "results.json").exists()
+    # nothing stored under the prefix leaves the directory as it was
+    storage.download_dir("checks/missing", tmp_path / "empty")
+    assert not (tmp_path / "empty").exists()
+
+
+def test_delete(tmp_path):
+    storage = make_storage(tmp_path)
+    storage.delete("checks/a/")
+    assert list(storage.list("checks/")) == ["checks/ab/x"]
+    storage.delete("checks/missing")
+    assert storage.exists("checks/ab/x")
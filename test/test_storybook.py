@@ -0,0 +1,112 @@
+import json
+import os
+from urllib.request import urlopen
+
+import storybook
+from helpful_scripts import LocalStorage
+from storybook import BuildCache, StaticServer, get_build_key, get_storycap_version
+
+YARN_LOCK = """\
+"@storybook/react@^6.5.0":
+  version "6.5.16"
+
+storycap@^3.1.0:
+  version "3.1.9"
+  resolved "https://registry.yarnpkg.com/storycap/-/storycap-3.1.9.tgz"
+"""
+
+YARN_BERRY_LOCK = """\
+"storycap@npm:^4.0.0":
+  version: 4.2.0
+  resolution: "storycap@npm:4.2.0"
+"""
+
+PNPM_LOCK = """\
+packages:
+
+  /storybook-addon/1.0.0:
+    resolution: {integrity: sha512-x}
+
+  /storycap/3.2.0:
+    resolution: {integrity: sha512-y}
+"""
+
+
+def test_storycap_from_package_lock(tmp_path):
+    lock = {"lockfileVersion": 2, "packages": {"node_modules/storycap": {"version": "3.1.9"}}}
+    (tmp_path / "package-lock.json").write_text(json.dumps(lock))
+    assert get_storycap_version(tmp_path) == "3.1.9"
+    lock = {"lockfileVersion": 1, "dependencies": {"storycap": {"version": "3.0.4"}}}
+    (tmp_path / "package-lock.json").write_text(json.dumps(lock))
+    assert get_storycap_version(tmp_path) == "3.0.4"
+
+
+def test_storycap_from_yarn_lock(tmp_path):
+    (tmp_path / "yarn.lock").write_text(YARN_LOCK)
+    assert get_storycap_version(tmp_path) == "3.1.9"
+    (tmp_path / "yarn.lock").write_text(YARN_BERRY_LOCK)
+    assert get_storycap_version(tmp_path) == "4.2.0"
+
+
+def test_storycap_from_pnpm_lock(tmp_path):
+    (tmp_path / "pnpm-lock.yaml").write_text(PNPM_LOCK)
+    assert get_storycap_version(tmp_path) == "3.2.0"
+
+
+def test_storycap_from_package_json(tmp_path):
+    assert get_storycap_version(tmp_path) is None
+    (tmp_path / "package.json").write_text(json.dumps({"devDependencies": {"storycap": "^3.1"}}))
+    assert get_storycap_version(tmp_path) == "^3.1"
+
+
+def test_build_key_needs_lockfile(tmp_path):
+    (tmp_path / "package.json").write_text("{}")
+    assert get_build_key("repo", "1111", tmp_path) is None
+    (tmp_path / "yarn.lock").write_text(YARN_LOCK)
+    key = get_build_key("repo", "1111", tmp_path)
+    assert key is not None
+    assert get_build_key("repo", "2222", tmp_path) != key
+
+
+def make_build(path, text):
+    (path / "static").mkdir(parents=True)
+    (path / "index.html").write_text(text)
+    (path / "static" / "main.js").write_text("main")
+    return path
+
+
+def test_build_cache_put_and_fetch(tmp_path):
+    storage = LocalStorage(tmp_path / "storage")
+    build = make_build(tmp_path / "build", "index")
+    BuildCache(storage, tmp_path / "cache").put("key", build)
+    assert storage.exists("storybook-builds/key.tar.gz")
+    # another worker, with nothing cached locally, gets it from storage
+    other = BuildCache(storage, tmp_path / "other-cache")
+    assert not other.fetch("missing", tmp_path / "nothing")
+    assert other.fetch("key", tmp_path / "fetched")
+    assert (tmp_path / "fetched" / "index.html").read_text() == "index"
+    assert (tmp_path / "fetched" / "static" / "main.js").read_text() == "main"
+    assert other.path("key").exists()
+
+
+def test_build_cache_evicts_least_recently_used(monkeypatch, tmp_path):
+    monkeypatch.setattr(storybook, "STATIC_BUILD_CACHE_SIZE", 2)
+    cache = BuildCache(LocalStorage(tmp_path / "storage"), tmp_path / "cache")
+    for n, key in enumerate("abc"):
+        cache.put(key, make_build(tmp_path / key, key))
+        os.utime(cache.path(key), (n, n))
+    cache.fetch("a", tmp_path / "fetched")
+    cache.put("d", make_build(tmp_path / "d", "d"))
+    assert sorted(path.name for path in (tmp_path / "cache").iterdir()) == [
+        "a.tar.gz",
+        "d.tar.gz",
+    ]
+    # still in storage for any worker
+    assert cache.fetch("b", tmp_path / "b-again")
+
+
+def test_static_server(tmp_path):
+    build = make_build(tmp_path / "build", "index")
+    with StaticServer(build) as server:
+        assert urlopen(f"{server.url}/index.html").read() == b"index"
+        assert urlopen(f"{server.url}/static/main.js").read() == b"main"